@@ -0,0 +1,6 @@
+"""Benchmarks of target-s3.
+
+    python -m benchmarks.run                 # every scenario, compared with the baselines
+    python -m benchmarks.run --save          # records the baselines
+    python -m benchmarks.tap --records 1000  # synthetic tap writing Singer messages to stdout
+"""
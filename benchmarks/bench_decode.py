@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of singer.parse_message against MessageDecoder with every
+installed JSON codec on RECORD, STATE and SCHEMA messages.
+
+    python benchmarks/bench_decode.py --width 50 --messages 20000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import singer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from target_s3 import messages  # noqa: E402
+
+
+def make_lines(width):
+    record = {'id': 1, 'created_at': '2021-01-01T00:00:00Z', 'amount': 12.34, 'tags': ['a', 'b']}
+    record.update({'field_{}'.format(i): 'value_{}'.format(i) for i in range(width)})
+    schema = {'type': 'object', 'properties': {key: {'type': ['null', 'string']} for key in record}}
+    return {
+        'RECORD': json.dumps({'type': 'RECORD', 'stream': 'benchmark', 'record': record}),
+        'STATE': json.dumps({'type': 'STATE', 'value': {'bookmarks': {'benchmark': {'id': 1}}}}),
+        'SCHEMA': json.dumps({'type': 'SCHEMA', 'stream': 'benchmark', 'schema': schema,
+                              'key_properties': ['id']}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    lines = make_lines(args.width)
+    decoders = [('singer.parse_message', lambda line: singer.parse_message(line).asdict())]
+    for codec in sorted(messages.CODECS):
+        decoders.append(('MessageDecoder({})'.format(codec), messages.MessageDecoder(codec).decode))
+
+    for message_type, line in lines.items():
+        print('{} messages of {} bytes'.format(message_type, len(line)))
+        baseline = None
+        for name, decode in decoders:
+            elapsed = min(timeit.repeat(lambda: decode(line), number=args.messages, repeat=3))
+            baseline = baseline or elapsed
+            print('  {:<26} {:.3f}s ({:.0f} messages/s, {:.1f}x)'.format(
+                name, elapsed, args.messages / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of utils.flatten_record against the schema compiled RecordFlattener
+on wide and nested records.
+
+    python benchmarks/bench_flatten.py --width 50 --depth 3 --records 20000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from target_s3 import utils  # noqa: E402
+from target_s3.flattening import RecordFlattener  # noqa: E402
+
+
+def make_schema(width, depth):
+    properties = {}
+    for i in range(width):
+        properties['field_{}'.format(i)] = {'type': ['null', 'string']}
+    properties['tags'] = {'type': ['null', 'array'], 'items': {'type': 'string'}}
+    if depth > 0:
+        properties['nested'] = {'type': ['null', 'object'], **make_schema(max(width // 2, 1), depth - 1)}
+    return {'type': 'object', 'properties': properties}
+
+
+def make_record(width, depth):
+    record = {'field_{}'.format(i): 'value_{}'.format(i) for i in range(width)}
+    record['tags'] = ['a', 'b']
+    if depth > 0:
+        record['nested'] = make_record(max(width // 2, 1), depth - 1)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--records', type=int, default=20000)
+    args = parser.parse_args()
+
+    schema = make_schema(args.width, args.depth)
+    record = make_record(args.width, args.depth)
+    flattener = RecordFlattener('benchmark', schema)
+    assert flattener.flatten(record) == utils.flatten_record(record)
+
+    baseline = min(timeit.repeat(lambda: utils.flatten_record(record), number=args.records, repeat=3))
+    compiled = min(timeit.repeat(lambda: flattener.flatten(record), number=args.records, repeat=3))
+    columns = len(utils.flatten_record(record))
+    print('{} records, {} columns'.format(args.records, columns))
+    print('utils.flatten_record: {:.3f}s ({:.0f} records/s)'.format(baseline, args.records / baseline))
+    print('RecordFlattener:      {:.3f}s ({:.0f} records/s)'.format(compiled, args.records / compiled))
+    print('speedup: {:.1f}x'.format(baseline / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Startup benchmark: time to import target_s3, and wall time of a run of
+the target receiving only SCHEMA and STATE messages, each in a fresh
+interpreter. Also lists the heavy modules each of them loaded.
+
+    python benchmarks/bench_import.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('pyarrow', 'pandas', 'numpy', 'boto3')
+
+IMPORT = '''
+import sys
+import target_s3
+print("loaded:" + ",".join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+'''
+
+# Runs main, then lists the heavy modules it loaded
+RUN = '''
+import sys
+import target_s3
+sys.argv = ["target-s3", "--config", {config!r}]
+target_s3.main()
+print("loaded:" + ",".join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+'''
+
+MESSAGES = [
+    {'type': 'SCHEMA', 'stream': 'users', 'key_properties': ['id', 'created_at'],
+     'schema': {'type': 'object', 'properties': {'id': {'type': 'integer'},
+                                                'created_at': {'type': 'string', 'format': 'date-time'}}}},
+    {'type': 'STATE', 'value': {'bookmarks': {'users': {'created_at': '2021-01-01T00:00:00Z'}}}},
+]
+
+
+def measure(code, stdin, runs):
+    timings = []
+    loaded = ''
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], input=stdin, cwd=ROOT, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        timings.append(time.perf_counter() - start)
+        loaded = [line[len('loaded:'):] for line in result.stderr.splitlines() if line.startswith('loaded:')]
+        loaded = loaded[-1] if loaded else ''
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump({'s3_bucket': 'target-s3-benchmark', 'field_to_partition_by_time': 'created_at'}, config_file)
+    try:
+        baseline, _ = measure('pass', '', args.runs)
+        imported, import_loaded = measure(IMPORT.format(heavy=HEAVY_MODULES), '', args.runs)
+        stdin = ''.join(json.dumps(message) + '\n' for message in MESSAGES)
+        ran, run_loaded = measure(RUN.format(config=config_file.name, heavy=HEAVY_MODULES), stdin, args.runs)
+    finally:
+        os.remove(config_file.name)
+
+    print('median of {} runs'.format(args.runs))
+    print('interpreter:            {:.3f}s'.format(baseline))
+    print('import target_s3:       {:.3f}s, loads: {}'.format(imported, import_loaded or '-'))
+    print('run without records:    {:.3f}s, loads: {}'.format(ran, run_loaded or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Per phase timing of a target run, by wrapping the functions doing each phase.
+
+Times are summed over calls and threads: the write and upload phases run in
+the flush workers, concurrently with the main thread. Phases done in parse
+worker processes (`parse_workers`) are not measured."""
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+import target_s3
+from target_s3 import buffers
+from target_s3 import columnar
+from target_s3 import messages
+from target_s3 import s3
+from target_s3 import writers
+
+# phase -> (owner, attribute) of the functions doing the phase
+PHASES = collections.OrderedDict([
+    ('parse', [(messages.MessageDecoder, 'decode')]),
+    ('validate', [(buffers.StreamBuffer, 'validate')]),
+    ('flatten', [(buffers.StreamBuffer, 'flatten')]),
+    ('buffer', [(columnar.ColumnarBuffer, 'append'), (columnar.ColumnarBuffer, 'append_table')]),
+    ('convert', [(buffers.StreamBuffer, 'seal'), (target_s3, 'add_partition_columns')]),
+    ('dedup', [(target_s3, 'filter_unique_records')]),
+    ('write', [(writers.PartitionWriter, 'write'), (writers.PartitionWriter, 'close')]),
+    ('upload', [(s3, 'upload_file'), (s3.MultipartUpload, '_put_object'), (s3.MultipartUpload, '_send_part'),
+                (s3.MultipartUpload, '_complete')]),
+])
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def wrap(self, phase, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.seconds[phase] += elapsed
+                    self.calls[phase] += 1
+        return timed
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Wraps the functions of every phase for the duration of the block"""
+        originals = []
+        try:
+            for phase, functions in PHASES.items():
+                for owner, name in functions:
+                    function = owner.__dict__[name]
+                    originals.append((owner, name, function))
+                    setattr(owner, name, self.wrap(phase, function))
+            yield self
+        finally:
+            for owner, name, function in reversed(originals):
+                setattr(owner, name, function)
+
+    def report(self):
+        return {phase: round(self.seconds[phase], 4) for phase in PHASES}
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Runs persist_messages over synthetic taps against a moto S3 stand-in and
+compares records/s and peak RSS with the baselines kept in baselines.json.
+
+    python -m benchmarks.run                        # every scenario
+    python -m benchmarks.run -s wide -s nested      # some scenarios
+    python -m benchmarks.run --config '{"flush_workers": 0}'
+    python -m benchmarks.run --save                 # records the baselines
+
+Each scenario runs in a fresh process so peak RSS is its own. moto keeps the
+uploaded objects in memory, so peak RSS includes the output of the run.
+Requires boto3 and moto."""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+BUCKET = 'target-s3-benchmark'
+
+SCENARIOS = {
+    'narrow': {'streams': 2, 'width': 10, 'depth': 0, 'records': 20000},
+    'wide': {'streams': 2, 'width': 100, 'depth': 0, 'records': 5000},
+    'nested': {'streams': 2, 'width': 20, 'depth': 3, 'records': 10000},
+    'partitions': {'streams': 4, 'width': 10, 'depth': 0, 'records': 20000, 'days': 365},
+    'duplicates': {'streams': 2, 'width': 10, 'depth': 0, 'records': 20000, 'duplicate_ratio': 0.2,
+                   'config': {'record_unique_field': 'id'}},
+}
+
+BASE_CONFIG = {
+    's3_bucket': BUCKET,
+    'field_to_partition_by_time': 'created_at',
+    'max_temp_file_size_mb': 1,
+}
+
+
+def run_scenario(name, options, extra_config):
+    """Runs a scenario, in a process of its own"""
+    # pylint: disable=import-outside-toplevel
+    import boto3
+    from moto import mock_aws
+
+    import target_s3
+    from benchmarks.phases import PhaseTimer
+    from benchmarks.tap import SyntheticTap
+
+    logging.disable(logging.INFO)
+    options = dict(options)
+    config = dict(BASE_CONFIG, **options.pop('config', {}))
+    config.update(extra_config)
+    lines = list(SyntheticTap(**options))
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BUCKET)
+
+        timer = PhaseTimer()
+        # The target writes the STATE messages to stdout
+        with timer.patch(), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            target_s3.persist_messages(lines, config, s3_client)
+            elapsed = time.perf_counter() - start
+
+        objects = [obj for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET)
+                   for obj in page.get('Contents', [])]
+
+    return {
+        'records': options['records'],
+        'seconds': round(elapsed, 3),
+        'records_per_second': round(options['records'] / elapsed),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'objects': len(objects),
+        'uploaded_mb': round(sum(obj['Size'] for obj in objects) / (1 << 20), 2),
+        'phases': timer.report(),
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    """Prints a scenario result next to its baseline, returns False on a regression"""
+    print('{}: {} records in {}s, {} records/s, peak RSS {} MB, {} objects ({} MB)'.format(
+        name, result['records'], result['seconds'], result['records_per_second'], result['peak_rss_mb'],
+        result['objects'], result['uploaded_mb']))
+    print('  phases (s): {}'.format(', '.join('{} {}'.format(phase, seconds)
+                                              for phase, seconds in result['phases'].items())))
+    if baseline is None:
+        print('  no baseline')
+        return True
+
+    ok = True
+    speed = result['records_per_second'] / baseline['records_per_second'] - 1
+    memory = result['peak_rss_mb'] / baseline['peak_rss_mb'] - 1
+    if speed < -tolerance:
+        ok = False
+        print('  REGRESSION records/s {:+.1%} vs baseline {}'.format(speed, baseline['records_per_second']))
+    if memory > tolerance:
+        ok = False
+        print('  REGRESSION peak RSS {:+.1%} vs baseline {} MB'.format(memory, baseline['peak_rss_mb']))
+    if ok:
+        print('  records/s {:+.1%}, peak RSS {:+.1%} vs baseline'.format(speed, memory))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks persist_messages against a moto S3 stand-in')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, repeatable (Default: every scenario)')
+    parser.add_argument('--config', default='{}', help='JSON object of target config overrides')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the records of the scenarios')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown or memory growth reported as a regression')
+    parser.add_argument('--baselines', default=BASELINES, help='Baselines file')
+    parser.add_argument('--save', action='store_true', help='Saves the results as the baselines')
+    args = parser.parse_args()
+
+    extra_config = json.loads(args.config)
+    # Baselines only compare with runs of the same size and config
+    comparable = args.scale == 1.0 and not extra_config
+    if args.save and not comparable:
+        parser.error('--save records baselines at the default --scale and --config only')
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as baselines_json:
+            baselines = json.load(baselines_json)
+
+    ok = True
+    for name in args.scenario or sorted(SCENARIOS):
+        options = dict(SCENARIOS[name])
+        options['records'] = max(int(options['records'] * args.scale), 1)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(run_scenario, name, options, extra_config).result()
+        ok = compare(name, result, baselines.get(name) if comparable else None, args.tolerance) and ok
+        baselines[name] = result
+
+    if args.save:
+        with open(args.baselines, 'w') as baselines_json:
+            json.dump(baselines, baselines_json, indent=2, sort_keys=True)
+            baselines_json.write('\n')
+        print('Saved baselines to {}'.format(args.baselines))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
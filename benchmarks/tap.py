@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Synthetic Singer tap generating streams of configurable shape.
+
+    python -m benchmarks.tap --streams 2 --width 20 --depth 1 --records 10000 | target-s3 -c config.json
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+
+START = datetime.datetime(2020, 1, 1)
+FIELD_TYPES = ('string', 'integer', 'number', 'boolean')
+
+
+def make_schema(width, depth):
+    properties = {}
+    for i in range(width):
+        properties['field_{}'.format(i)] = {'type': ['null', FIELD_TYPES[i % len(FIELD_TYPES)]]}
+    properties['tags'] = {'type': ['null', 'array'], 'items': {'type': 'string'}}
+    if depth > 0:
+        properties['nested'] = {**make_schema(max(width // 2, 1), depth - 1), 'type': ['null', 'object']}
+    return {'type': 'object', 'properties': properties}
+
+
+def make_record(rng, width, depth):
+    record = {}
+    for i in range(width):
+        field_type = FIELD_TYPES[i % len(FIELD_TYPES)]
+        if field_type == 'string':
+            value = 'value_{}'.format(rng.randrange(1000))
+        elif field_type == 'integer':
+            value = rng.randrange(1 << 31)
+        elif field_type == 'number':
+            value = round(rng.random() * 1000, 2)
+        else:
+            value = rng.random() < 0.5
+        record['field_{}'.format(i)] = value
+    record['tags'] = ['a', 'b']
+    if depth > 0:
+        record['nested'] = make_record(rng, max(width // 2, 1), depth - 1)
+    return record
+
+
+class SyntheticTap:
+    """Iterates over the lines of a tap run: a SCHEMA message per stream, then
+    `records` RECORD messages dealt round robin to the streams, with a STATE
+    message every `state_every` records.
+
+    The `created_at` of the records is spread over `days` days, so over as many
+    partitions. A `duplicate_ratio` share of the records reuse the id of an
+    earlier record of their stream."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, streams=2, width=20, depth=1, records=10000, days=30, duplicate_ratio=0.0,
+                 state_every=1000, seed=0):
+        self.streams = ['stream_{}'.format(i) for i in range(streams)]
+        self.width = width
+        self.depth = depth
+        self.records = records
+        self.days = days
+        self.duplicate_ratio = duplicate_ratio
+        self.state_every = state_every
+        self.seed = seed
+
+    def schema(self):
+        schema = make_schema(self.width, self.depth)
+        schema['properties']['id'] = {'type': ['null', 'integer']}
+        schema['properties']['created_at'] = {'type': ['null', 'string'], 'format': 'date-time'}
+        return schema
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        schema = self.schema()
+        for stream in self.streams:
+            yield json.dumps({'type': 'SCHEMA', 'stream': stream, 'schema': schema,
+                              'key_properties': ['id', 'created_at']})
+
+        seconds = self.days * 86400
+        for i in range(self.records):
+            stream = self.streams[i % len(self.streams)]
+            record_id = i // len(self.streams)
+            if record_id and rng.random() < self.duplicate_ratio:
+                record_id = rng.randrange(record_id)
+            record = make_record(rng, self.width, self.depth)
+            record['id'] = record_id
+            record['created_at'] = (START + datetime.timedelta(seconds=rng.randrange(seconds))).isoformat() + 'Z'
+            yield json.dumps({'type': 'RECORD', 'stream': stream, 'record': record})
+            if (i + 1) % self.state_every == 0:
+                yield json.dumps({'type': 'STATE', 'value': {'records': i + 1}})
+        yield json.dumps({'type': 'STATE', 'value': {'records': self.records}})
+
+
+def add_arguments(parser):
+    parser.add_argument('--streams', type=int, default=2, help='Number of streams')
+    parser.add_argument('--width', type=int, default=20, help='Top level fields per record')
+    parser.add_argument('--depth', type=int, default=1, help='Levels of nested objects')
+    parser.add_argument('--records', type=int, default=10000, help='Records over all the streams')
+    parser.add_argument('--days', type=int, default=30, help='Days the records are spread over')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='Share of records reusing an id')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the Singer messages of a synthetic tap to stdout')
+    add_arguments(parser)
+    args = parser.parse_args()
+    tap = SyntheticTap(args.streams, args.width, args.depth, args.records, args.days, args.duplicate_ratio,
+                       seed=args.seed)
+    for line in tap:
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
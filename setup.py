@@ -25,8 +25,8 @@ setup(name="target-s3",
           "backoff==1.8.0",
           "jsonlines==1.2.0",
           "jsonschema==2.6.0",
-          "pandas==1.1.2",
-          "pyarrow==1.0.1",
+          "numpy==1.21.6",
+          "pyarrow==7.0.0",
           "boto3==1.15.4",
       ],
       entry_points="""
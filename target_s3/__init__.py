@@ -1,133 +1,84 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import gzip
 import io
+import itertools
 import json
-import os
-from os import walk
-import shutil
 import sys
-import tempfile
-from datetime import datetime
-import pandas as pd
-import pyarrow as pa
-import itertools
-from io import StringIO
-from sys import getsizeof
-import pickle
 
 import singer
-from jsonschema import Draft4Validator, FormatChecker
 
+from target_s3 import metrics
 from target_s3 import s3
 from target_s3 import utils
+from target_s3.batching import BatchController
+from target_s3.checkpoints import StateCheckpoints
+from target_s3.flush import FlushPipeline
+from target_s3.messages import MessageDecoder
+
+# The modules needing pyarrow or boto3 are imported when the first record
+# arrives, syncs without records start and exit without loading them
 
 logger = singer.get_logger()
 
 
-def write_temp_pickle(data={}):
-    temp_unique_pkl = 'temp_unique.pickle'
-    dir_temp_file = os.path.join(tempfile.gettempdir(), temp_unique_pkl)
-    with open(dir_temp_file, 'wb') as handle:
-        pickle.dump(data, handle)
+def filter_unique_records(table, record_unique_field, dedup_index):
+    """Drops the records whose record_unique_field was already uploaded by a
+    previous flush of the stream"""
+    logger.info('table orginal size: {}'.format(table.shape))
+    if not record_unique_field or record_unique_field not in table.column_names:
+        return table
+
+    import pyarrow as pa
+
+    already_processed = dedup_index.contains(table.column(record_unique_field).to_pylist())
+    table = table.filter(pa.array([not processed for processed in already_processed]))
+    logger.info('table filtered size: {}'.format(table.shape))
+    new_unique_ids = set(table.column(record_unique_field).to_pylist())
+    logger.info('unique_ids_already_processed: {}, new_unique_ids: {}'.format(
+        dedup_index.size, len(new_unique_ids)))
+    dedup_index.add(new_unique_ids)
+
+    insert_id_count = len(new_unique_ids)
+    logger.info('table size: {}, record_unique_field count: {}'.format(table.shape, insert_id_count))
+    return table
+
 
+# pyarrow.compute functions deriving the partition columns
+PARTITION_FUNCTIONS = {'idx_year': 'year', 'idx_month': 'month', 'idx_day': 'day', 'idx_hour': 'hour'}
 
-def read_temp_pickle():
-    data = {}
-    temp_unique_pkl = 'temp_unique.pickle'
-    dir_temp_file = os.path.join(tempfile.gettempdir(), temp_unique_pkl)
-    if os.path.isfile(dir_temp_file):
-        with open(dir_temp_file, 'rb') as handle:
-            data = pickle.load(handle)
-    return data
+
+def add_partition_columns(table, field_to_partition_by_time, partition_columns=None):
+    """Derives the idx_ partition columns from a single parse of the partition field"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from target_s3 import columnar
+    from target_s3.writers import PARTITION_COLUMNS
+
+    partition_columns = partition_columns or PARTITION_COLUMNS
+    # Partitions follow the wall clock time of the values in their own offset
+    timestamps = table.column(field_to_partition_by_time)
+    if columnar.PARTITION_TIME in table.column_names:
+        timestamps = pc.coalesce(table.column(columnar.PARTITION_TIME), timestamps.cast(pa.timestamp('us')))
+        table = table.drop([columnar.PARTITION_TIME])
+    elif pa.types.is_date(timestamps.type) and 'idx_hour' in partition_columns:
+        timestamps = timestamps.cast(pa.timestamp('us'))
+    elif not (pa.types.is_timestamp(timestamps.type) or pa.types.is_date(timestamps.type)):
+        timestamps = pa.chunked_array([columnar.to_wall_clock(chunk.cast(pa.string())) for chunk in timestamps.chunks],
+                                      type=pa.timestamp('us'))
+    for name in partition_columns:
+        table = table.append_column(name, getattr(pc, PARTITION_FUNCTIONS[name])(timestamps))
+    return table
 
 
 # Upload created files to S3
-def upload_to_s3(s3_client, s3_bucket, filename, stream, field_to_partition_by_time,
-                 record_unique_field, compression=None, encryption_type=None, encryption_key=None):
-    data = None
-    df = None
-    final_files_dir = ''
-    with open(filename, 'r') as f:
-        data = f.read().splitlines()
-
-        df = pd.DataFrame(data)
-        df.columns = ['json_element']
-        df = df['json_element'].apply(json.loads)
-        df = pd.json_normalize(df)
-        logger.info('df orginal size: {}'.format(df.shape))
-
-    if df is not None:
-        if record_unique_field and record_unique_field in df:
-            unique_ids_already_processed = read_temp_pickle()
-            df = df[~df[record_unique_field].isin(unique_ids_already_processed)]
-            logger.info('df filtered size: {}'.format(df.shape))
-            df = df.drop_duplicates()
-            logger.info('df after drop_duplicates size: {}'.format(df.shape))
-            # df = df.groupby(record_unique_field).first().reset_index()
-            # logger.info('df first record of each unique_id size: {}'.format(df.shape))
-            new_unique_ids = set(df[record_unique_field].unique())
-            logger.info('unique_ids_already_processed: {}, new_unique_ids: {}'.format(
-                len(unique_ids_already_processed), len(new_unique_ids)))
-            unique_ids_already_processed = set(unique_ids_already_processed).union(new_unique_ids)
-            write_temp_pickle(unique_ids_already_processed)
-
-            df = df.infer_objects()
-            dtypes = {}
-            for c in df.columns:
-                try:
-                    df[c] = pd.to_numeric(df[c])
-                    dtypes[str(df[c].dtype)] = dtypes.get(str(df[c].dtype), 0) + 1
-                except:
-                    pass
-            logger.info('df info: {}'.format(dtypes))
-            logger.info('df infer_objects/to_numeric size: {}'.format(df.shape))
-
-        dir_path = os.path.dirname(os.path.realpath(filename))
-        final_files_dir = os.path.join(dir_path, s3_bucket)
-        final_files_dir = os.path.join(final_files_dir, stream)
-        insert_id_count = len(df[record_unique_field].unique())
-        logger.info('df size: {}, record_unique_field count: {}'.format(df.shape, insert_id_count))
-
-        logger.info('final_files_dir: {}'.format(final_files_dir))
-        df['idx_day'] = pd.DatetimeIndex(pd.to_datetime(df[field_to_partition_by_time])).day
-        df['idx_month'] = pd.DatetimeIndex(pd.to_datetime(df[field_to_partition_by_time])).month
-        df['idx_year'] = pd.DatetimeIndex(pd.to_datetime(df[field_to_partition_by_time])).year
-
-    filename_sufix_map = {'snappy': 'snappy', 'gzip': 'gz', 'brotli': 'br'}
-    if compression is None or compression.lower() == "none":
-        df.to_parquet(final_files_dir, index=True, compression=None,
-                      partition_cols=['idx_year', 'idx_month', 'idx_day'])
-    else:
-        if compression in filename_sufix_map:
-            df.to_parquet(final_files_dir, index=False, compression=compression,
-                          partition_cols=['idx_year', 'idx_month', 'idx_day'])
-        else:
-            raise NotImplementedError(
-                """Compression type '{}' is not supported. Expected: {}""".format(compression,
-                                                                                  filename_sufix_map.keys())
-            )
-
-    for (dirpath, dirnames, filenames) in walk(final_files_dir):
-        for fn in filenames:
-            temp_file = os.path.join(dirpath, fn)
-            s3_target = os.path.join(dirpath.split(s3_bucket)[-1], fn)
-            s3_target = s3_target.lstrip('/')
-            s3.upload_file(temp_file,
-                           s3_client,
-                           s3_bucket,
-                           s3_target,
-                           encryption_type=encryption_type,
-                           encryption_key=encryption_key)
-
-    # Remove the local file(s)
-    for (dirpath, dirnames, filenames) in walk(final_files_dir):
-        for fn in filenames:
-            temp_file = os.path.join(dirpath, fn)
-            os.remove(temp_file)
-    os.remove(filename)
+# pylint: disable=too-many-arguments
+def upload_to_s3(writers, table, stream, field_to_partition_by_time, batch=None, controller=None, batch_bytes=None):
+    with metrics.timer('flush_stage_duration', stream=stream, stage='partition'):
+        table = add_partition_columns(table, field_to_partition_by_time, writers.partition_columns)
+    written_bytes, partitions = writers.write(stream, table, batch)
+    if controller is not None:
+        controller.observe(stream, batch_bytes or table.nbytes, written_bytes, partitions)
 
 
 def emit_state(state):
@@ -138,141 +89,196 @@ def emit_state(state):
         sys.stdout.flush()
 
 
+def emit_durable_state(pipeline, writers, checkpoints):
+    """Emits the latest STATE whose records are all durable in S3. A batch is
+    durable once it and every earlier batch landed, and no file it was
+    written to is still open or uploading. The files holding the batches of
+    an overdue STATE are finished once those batches landed."""
+    durable_batch = pipeline.collect()
+    overdue_batch = checkpoints.overdue_batch()
+    if overdue_batch is not None and overdue_batch <= durable_batch:
+        writers.finish_batches(overdue_batch)
+    oldest_batch = writers.oldest_batch()
+    if oldest_batch is not None:
+        durable_batch = min(durable_batch, oldest_batch - 1)
+    emit_state(checkpoints.pop_durable(durable_batch))
+
+
+# pylint: disable=too-many-arguments
+def flush_stream(pipeline, dedup, writers, checkpoints, controller, config, stream, table):
+    """Deduplicates a sealed batch and hands it to the flush pipeline. The
+    deduplication runs in the main thread so batches are filtered in order."""
+    num_rows, batch_bytes = table.num_rows, table.nbytes
+    if config.get('record_unique_field'):
+        with metrics.timer('flush_stage_duration', stream=stream, stage='dedup'):
+            table = filter_unique_records(table, config.get('record_unique_field'), dedup.index(stream))
+        metrics.increment('records_dropped_dedup', num_rows - table.num_rows, stream=stream)
+    # Batches are numbered from 1 in submission order
+    batch = pipeline.submitted + 1
+    checkpoints.sealed(stream, batch)
+    pipeline.submit(metrics.profiled, 'flush-{}'.format(stream),
+                    upload_to_s3, writers, table, stream, config.get('field_to_partition_by_time'), batch,
+                    controller, batch_bytes)
+    emit_durable_state(pipeline, writers, checkpoints)
+    metrics.current().maybe_log()
+
+
 def persist_messages(messages, config, s3_client):
+    """Uploads the records of the messages to S3. STATE messages are emitted
+    as soon as the records received before them are durable in S3, the last
+    STATE received is returned.
+
+    Until the first record nothing needs to be written: the schemas are kept
+    and the buffers, writers and arrow engine are only set up when a record
+    arrives. Without records the last STATE is emitted right away."""
+    if config.get('parse_workers', 0) > 0:
+        from target_s3 import parallel
+        parsed_messages = parallel.parse_messages(messages, config)
+    else:
+        parsed_messages = MessageDecoder(config.get('json_codec', 'auto')).decode_all(messages)
+
     state = None
-    schemas = {}
-    key_properties = {}
-    headers = {}
-    validators = {}
-
-    filenames = []
-    file_size_counters = dict()
-    file_count_counters = dict()
-    file_data = dict()
-    filename = None
-    s3_path, s3_filename = None, None
-    now = datetime.now().strftime('%Y%m%dT%H%M%S')
-    max_file_size_mb = config.get('max_temp_file_size_mb', 1000)
-    stream = None
+    schemas = []
+    try:
+        for o in parsed_messages:
+            message_type = o['type']
+
+            if message_type in ('RECORD', 'RECORD_BATCH'):
+                return persist_records(itertools.chain(schemas, [o], parsed_messages), config, s3_client, state)
+            if message_type == 'STATE':
+                logger.debug('Setting state to {}'.format(o['value']))
+                state = o['value']
+            elif message_type == 'SCHEMA':
+                schemas.append(o)
+            elif message_type == 'ACTIVATE_VERSION':
+                logger.debug('ACTIVATE_VERSION message')
+            else:
+                logger.warning("Unknown message type {} in message {}".format(o['type'], o))
+    finally:
+        parsed_messages.close()
 
-    if config.get('record_unique_field'):
-        a = set()
-        write_temp_pickle()
-
-    for message in messages:
-        try:
-            o = singer.parse_message(message).asdict()
-        except json.decoder.JSONDecodeError:
-            logger.error("Unable to parse:\n{}".format(message))
-            raise
-        message_type = o['type']
-        # if message_type != 'RECORD':
-        #     logger.info("{} - message: {}".format(message_type, o))
-
-        # if message_type not in message_types:
-        #     logger.info("{} - message: {}".format(message_type, o))
-
-        if message_type == 'RECORD':
-            if o['stream'] not in schemas:
-                raise Exception("A record for stream {}"
-                                "was encountered before a corresponding schema".format(o['stream']))
-
-            # Validate record
-            try:
-                validators[o['stream']].validate(utils.float_to_decimal(o['record']))
-            except Exception as ex:
-                if type(ex).__name__ == "InvalidOperation":
-                    logger.error("""Data validation failed and cannot load to destination. RECORD: {}\n
-                    'multipleOf' validations that allows long precisions are not supported 
-                    (i.e. with 15 digits or more). Try removing 'multipleOf' methods from JSON schema.
-                    """.format(o['record']))
-                    raise ex
-
-            record_to_load = o['record']
-            if config.get('add_metadata_columns'):
-                record_to_load = utils.add_metadata_values_to_record(o, {})
+    logger.info('No records received')
+    emit_state(state)
+    return state
+
+
+def persist_records(messages, config, s3_client, state=None):
+    """Uploads the records of already parsed messages to S3, `state` is the
+    last STATE received before them"""
+    from target_s3.buffers import BufferManager, prepare_record, prepare_schema
+    from target_s3.dedup import DedupStore
+    from target_s3.writers import PartitionWriterManager
+
+    checkpoints = StateCheckpoints(config.get('checkpoint_interval_seconds', 30))
+    if state is not None:
+        checkpoints.add(state, [])
+    controller = BatchController(config.get('flush_target_mb'),
+                                 config.get('flush_max_rows'),
+                                 config.get('flush_max_latency_seconds'),
+                                 config.get('total_buffer_memory_mb'))
+    run_metrics = metrics.start(config)
+    buffers = BufferManager(config)
+    pipeline = FlushPipeline(config.get('flush_workers', 2), config.get('max_pending_flushes'))
+    dedup = DedupStore(config.get('dedup_max_memory_mb', 64))
+    writers = PartitionWriterManager(s3_client, config.get("s3_bucket"),
+                                     utils.parquet_compression(config.get("compression")),
+                                     config.get('output_mode', 'local'),
+                                     config.get('multipart_chunk_size_mb', 8),
+                                     config.get('target_file_size_mb', 128),
+                                     config.get('max_open_partition_writers', 64),
+                                     config.get('encryption_type'),
+                                     config.get('encryption_key'),
+                                     config.get('upload_workers', 8),
+                                     s3.transfer_config(config),
+                                     granularity=config.get('partition_granularity', 'day'),
+                                     sort_by=config.get('sort_by'),
+                                     row_group_size=config.get('row_group_size'),
+                                     data_page_size=(config['data_page_size_kb'] << 10
+                                                     if config.get('data_page_size_kb') else None),
+                                     use_dictionary=config.get('use_dictionary', True),
+                                     write_metadata_files=config.get('write_metadata_files', False),
+                                     max_open_files_mb=config.get('max_open_files_mb', 2048))
+
+    try:
+        for o in messages:
+            message_type = o['type']
+
+            if message_type == 'RECORD':
+                if o['stream'] not in buffers:
+                    raise Exception("A record for stream {}"
+                                    "was encountered before a corresponding schema".format(o['stream']))
+                buffer = buffers.get(o['stream'])
+
+                buffer.append(prepare_record(o, buffer, config))
+
+                reason = controller.should_seal(buffer)
+                if reason:
+                    logger.info('Flushing stream {}: {}'.format(buffer.stream, reason))
+                    flush_stream(pipeline, dedup, writers, checkpoints, controller, config, buffer.stream,
+                                 buffer.seal())
+            elif message_type == 'RECORD_BATCH':
+                # Records already validated, flattened and converted by a parse worker
+                buffer = buffers.get(o['stream'])
+                buffer.append_table(o['table'])
+                reason = controller.should_seal(buffer)
+                if reason:
+                    logger.info('Flushing stream {}: {}'.format(buffer.stream, reason))
+                    flush_stream(pipeline, dedup, writers, checkpoints, controller, config, buffer.stream,
+                                 buffer.seal())
+            elif message_type == 'STATE':
+                logger.debug('Setting state to {}'.format(o['value']))
+                state = o['value']
+                checkpoints.add(state, [stream for stream, buffer in buffers.buffers.items() if buffer.num_rows > 0])
+                emit_durable_state(pipeline, writers, checkpoints)
+                run_metrics.maybe_log()
+            elif message_type == 'SCHEMA':
+                stream = o['stream']
+                schema = prepare_schema(o, config)
+                table = buffers.set_schema(stream, schema, o['key_properties'])
+                if table is not None:
+                    flush_stream(pipeline, dedup, writers, checkpoints, controller, config, stream, table)
+
+            elif message_type == 'ACTIVATE_VERSION':
+                logger.debug('ACTIVATE_VERSION message')
             else:
-                record_to_load = utils.remove_metadata_values_from_record(o)
-
-            flattened_record = utils.flatten_record(record_to_load)
-
-            if filename is None:
-                filename = '{}.jsonl'.format(now)
-                filename = os.path.join(tempfile.gettempdir(), filename)
-                filename = os.path.expanduser(filename)
-                file_size_counters[filename] = 0
-                file_count_counters[filename] = file_count_counters.get(filename, 1)
-
-            full_s3_target = str(file_count_counters[filename]) + '_' + filename
-
-            if not (filename, full_s3_target) in filenames:
-                filenames.append((filename, full_s3_target))
-
-            file_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
-            if file_size >> 20 > file_size_counters[filename] and file_size >> 20 % 100 == 0:
-                logger.info('file_size: {} MB, filename: {}'.format(round(file_size >> 20, 2), filename))
-                file_size_counters[filename] = file_size_counters.get(filename, 0) + 10
-
-            if file_size >> 20 > max_file_size_mb:
-                logger.info('Max file size reached: {}, dumping to s3...'.format(max_file_size_mb))
-
-                upload_to_s3(s3_client, config.get("s3_bucket"), filename, stream,
-                             config.get('field_to_partition_by_time'),
-                             config.get('record_unique_field'),
-                             config.get("compression"),
-                             config.get('encryption_type'),
-                             config.get('encryption_key'))
-                file_size = 0
-                file_count_counters[filename] = file_count_counters.get(filename, 1) + 1
-                if filename in headers:
-                    del headers[filename]
-
-            file_is_empty = file_size == 0
-            if file_is_empty:
-                logger.info('creating file: {}'.format(filename))
-
-            with open(filename, 'a') as f:
-                f.write(json.dumps(flattened_record))
-                f.write('\n')
-
-            state = None
-        elif message_type == 'STATE':
-            logger.debug('Setting state to {}'.format(o['value']))
-            state = o['value']
-        elif message_type == 'SCHEMA':
-            stream = o['stream']
-            schemas[stream] = o['schema']
-            if config.get('add_metadata_columns'):
-                schemas[stream] = utils.add_metadata_columns_to_schema(o)
-
-            schema = utils.float_to_decimal(o['schema'])
-            validators[stream] = Draft4Validator(schema, format_checker=FormatChecker())
-            key_properties[stream] = o['key_properties']
-            filename = None
-
-            if config.get('field_to_partition_by_time') not in key_properties[stream]:
-                raise Exception("""field_to_partition_by_time '{}' is not in key_properties: {}""".format(
-                    config.get('field_to_partition_by_time'), key_properties[stream])
-                )
-
-        elif message_type == 'ACTIVATE_VERSION':
-            logger.debug('ACTIVATE_VERSION message')
-        else:
-            logger.warning("Unknown message type {} in message {}".format(o['type'], o))
-
-    # Upload created CSV files to S3
-    for filename, s3_target in filenames:
-        upload_to_s3(s3_client, config.get("s3_bucket"), filename, stream,
-                     config.get('field_to_partition_by_time'),
-                     config.get('record_unique_field'),
-                     config.get("compression"),
-                     config.get('encryption_type'),
-                     config.get('encryption_key'))
+                logger.warning("Unknown message type {} in message {}".format(o['type'], o))
+
+            for buffer, reason in controller.due(buffers):
+                logger.info('Flushing stream {}: {}'.format(buffer.stream, reason))
+                flush_stream(pipeline, dedup, writers, checkpoints, controller, config, buffer.stream,
+                             buffer.seal())
+
+            if checkpoints.overdue():
+                for stream in checkpoints.overdue_streams():
+                    logger.info('Flushing stream {}: a STATE is waiting on its records'.format(stream))
+                    flush_stream(pipeline, dedup, writers, checkpoints, controller, config, stream,
+                                 buffers.get(stream).seal())
+                overdue_batch = checkpoints.overdue_batch()
+                if overdue_batch is not None and pipeline.collect() >= overdue_batch:
+                    emit_durable_state(pipeline, writers, checkpoints)
+
+        # Upload the remaining buffered records to S3
+        for stream, table in buffers.drain():
+            flush_stream(pipeline, dedup, writers, checkpoints, controller, config, stream, table)
+        pipeline.wait()
+        writers.close()
+        emit_durable_state(pipeline, writers, checkpoints)
+    finally:
+        buffers.close()
+        pipeline.shutdown()
+        writers.abort()
+        dedup.close()
+        run_metrics.close()
 
     return state
 
 
 def main():
+    if sys.argv[1:2] == ['compact']:
+        from target_s3 import compact
+        compact.main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Config file')
     args = parser.parse_args()
@@ -288,12 +294,12 @@ def main():
         logger.error("Invalid configuration:\n   * {}".format('\n   * '.join(config_errors)))
         sys.exit(1)
 
-    s3_client = s3.create_client(config)
+    # The client is created by the first upload, syncs without records never need it
+    s3_client = s3.LazyClient(config)
 
     input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    state = persist_messages(input_messages, config, s3_client)
+    persist_messages(input_messages, config, s3_client)
 
-    emit_state(state)
     logger.debug("Exiting normally")
 
 
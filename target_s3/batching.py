@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+import singer
+
+logger = singer.get_logger()
+
+# Parquet bytes per byte of arrow table assumed until a flush of the stream
+# is observed
+DEFAULT_COMPRESSION_RATIO = 0.25
+# Weight of the latest flush in the learned ratios
+SMOOTHING = 0.3
+# The latency and memory triggers are checked every CHECK_MESSAGES messages
+# or CHECK_SECONDS seconds, whichever comes first
+CHECK_MESSAGES = 1000
+CHECK_SECONDS = 1.0
+
+
+def smooth(previous, value):
+    return value if previous is None else previous + SMOOTHING * (value - previous)
+
+
+class StreamStats:
+    """What the flushes of a stream taught about its output"""
+
+    def __init__(self):
+        self.compression_ratio = None
+        self.partitions = None
+
+
+class BatchController:
+    """Decides when the buffer of a stream is sealed and flushed.
+
+    A buffer is sealed when it reaches its `max_temp_file_size_mb`, when it
+    holds `max_rows` rows, when its oldest record was buffered more than
+    `max_latency` seconds ago, or when the buffers of every stream hold more
+    than `total_memory_mb` in memory, largest buffer first.
+
+    With `target_mb` set, a buffer is also sealed once the parquet data it
+    would add to each of its partitions is expected to reach `target_mb`.
+    The expectation is learned from the previous flushes of the stream: the
+    ratio of parquet bytes written to arrow bytes flushed, and the number of
+    partitions a flush spreads over."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, target_mb=None, max_rows=None, max_latency=None, total_memory_mb=None):
+        self.target_bytes = target_mb << 20 if target_mb else None
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.total_memory_bytes = total_memory_mb << 20 if total_memory_mb else None
+        self.stats = {}
+        # Arrow bytes a buffer is sealed at, by stream
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.last_check = time.monotonic()
+
+    def _limit(self, stream):
+        limit = self.limits.get(stream)
+        if limit is None:
+            with self.lock:
+                stats = self.stats.get(stream) or StreamStats()
+                ratio = stats.compression_ratio or DEFAULT_COMPRESSION_RATIO
+                limit = self.limits[stream] = self.target_bytes * (stats.partitions or 1) / ratio
+        return limit
+
+    def should_seal(self, buffer):
+        """Returns why the buffer of a stream should be sealed after an append, None if it shouldn't"""
+        if buffer.is_full():
+            return 'max size of {} MB reached'.format(buffer.max_size_bytes >> 20)
+        if self.max_rows and buffer.num_rows >= self.max_rows:
+            return 'max rows of {} reached'.format(self.max_rows)
+        if self.target_bytes and buffer.records.size_bytes * buffer.arrow_ratio >= self._limit(buffer.stream):
+            return 'expected to write {} MB per partition'.format(self.target_bytes >> 20)
+        return None
+
+    def due(self, buffers):
+        """Returns the (buffer, reason) pairs of the buffers to seal because of
+        their latency or of the total memory budget"""
+        if self.max_latency is None and self.total_memory_bytes is None:
+            return []
+        self.messages += 1
+        now = time.monotonic()
+        if self.messages < CHECK_MESSAGES and now - self.last_check < CHECK_SECONDS:
+            return []
+        self.messages = 0
+        self.last_check = now
+
+        due = []
+        if self.max_latency is not None:
+            for buffer in buffers.buffers.values():
+                if buffer.num_rows > 0 and now - buffer.first_append >= self.max_latency:
+                    due.append((buffer, 'oldest record buffered {:.0f}s ago'.format(now - buffer.first_append)))
+        if self.total_memory_bytes is not None:
+            candidates = [buffer for buffer in buffers.buffers.values()
+                          if buffer.num_rows > 0 and all(buffer is not b for b, _ in due)]
+            memory = sum(buffer.records.memory_bytes for buffer in candidates)
+            for buffer in sorted(candidates, key=lambda b: b.records.memory_bytes, reverse=True):
+                if memory <= self.total_memory_bytes:
+                    break
+                due.append((buffer, 'total memory budget of {} MB reached'.format(self.total_memory_bytes >> 20)))
+                memory -= buffer.records.memory_bytes
+        return due
+
+    def observe(self, stream, batch_bytes, written_bytes, partitions):
+        """Learns from a flush of `batch_bytes` arrow bytes that wrote
+        `written_bytes` parquet bytes to `partitions` partitions"""
+        if batch_bytes <= 0 or partitions <= 0:
+            return
+        with self.lock:
+            stats = self.stats.setdefault(stream, StreamStats())
+            stats.compression_ratio = smooth(stats.compression_ratio, max(written_bytes, 1) / batch_bytes)
+            stats.partitions = smooth(stats.partitions, partitions)
+            self.limits.pop(stream, None)
+        logger.debug('Stream {}: compression ratio {:.3f}, {:.1f} partitions per flush'.format(
+            stream, stats.compression_ratio, stats.partitions))
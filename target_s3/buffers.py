@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import time
+
+import singer
+
+from target_s3 import columnar
+from target_s3 import metrics
+from target_s3 import batching
+from target_s3 import dedup
+from target_s3 import utils
+from target_s3.flattening import KeyPathCache, RecordFlattener
+from target_s3.validation import RecordValidator
+
+logger = singer.get_logger()
+
+
+def prepare_schema(o, config):
+    """Returns the schema of a SCHEMA message, extended with the metadata columns if enabled"""
+    schema = o['schema']
+    if config.get('add_metadata_columns'):
+        schema = utils.add_metadata_columns_to_schema(o)['schema']
+
+    if config.get('field_to_partition_by_time') not in o['key_properties']:
+        raise Exception("""field_to_partition_by_time '{}' is not in key_properties: {}""".format(
+            config.get('field_to_partition_by_time'), o['key_properties'])
+        )
+    return schema
+
+
+def prepare_record(o, buffer, config):
+    """Validates a RECORD message and returns its flattened record"""
+    # Validate record
+    try:
+        buffer.validate(o['record'])
+    except Exception as ex:
+        if type(ex).__name__ == "InvalidOperation":
+            logger.error("""Data validation failed and cannot load to destination. RECORD: {}\n
+            'multipleOf' validations that allows long precisions are not supported 
+            (i.e. with 15 digits or more). Try removing 'multipleOf' methods from JSON schema.
+            """.format(o['record']))
+            raise ex
+
+    record_to_load = o['record']
+    if config.get('add_metadata_columns'):
+        record_to_load = utils.add_metadata_values_to_record(o, {})
+    else:
+        record_to_load = utils.remove_metadata_values_from_record(o)
+
+    return buffer.flatten(record_to_load)
+
+
+class StreamBuffer:
+    """Schema, validator and buffered records of a single stream"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, stream, schema, key_properties, max_size_mb, validator, flattener,
+                 memory_budget_mb=None, dedup_policy='none', partition_field=None):
+        self.stream = stream
+        self.schema = schema
+        self.key_properties = key_properties
+        self.validator = validator
+        self.flattener = flattener
+        self.max_size_bytes = max_size_mb << 20
+        self.memory_budget_mb = memory_budget_mb
+        self.dedup_policy = dedup_policy
+        self.partition_field = partition_field
+        self.types = columnar.arrow_types(schema)
+        self.records = columnar.ColumnarBuffer(schema, memory_budget_mb, self.types, partition_field)
+        # When the oldest buffered record was appended
+        self.first_append = None
+        # Size of the sealed arrow tables per byte of records.size_bytes
+        self.arrow_ratio = 1.0
+
+    @property
+    def num_rows(self):
+        return self.records.num_rows
+
+    def validate(self, record):
+        self.validator.validate(record)
+
+    def flatten(self, record):
+        return self.flattener.flatten(record)
+
+    def append(self, record):
+        if self.first_append is None:
+            self.first_append = time.monotonic()
+        self.records.append(record)
+
+    def append_table(self, table):
+        if self.first_append is None:
+            self.first_append = time.monotonic()
+        self.records.append_table(table)
+
+    def is_full(self):
+        return self.records.size_bytes > self.max_size_bytes
+
+    def seal(self):
+        """Returns the buffered records as an arrow table and starts a new buffer"""
+        with metrics.timer('flush_stage_duration', stream=self.stream, stage='seal'):
+            table = self.records.to_table()
+        metrics.increment('records_in', self.records.num_rows, stream=self.stream)
+        metrics.increment('bytes_buffered', self.records.size_bytes, stream=self.stream)
+        if self.records.size_bytes > 0:
+            self.arrow_ratio = batching.smooth(self.arrow_ratio, table.nbytes / self.records.size_bytes)
+        logger.info('Sealing buffer of stream {}: {} rows, ~{} MB'.format(
+            self.stream, self.records.num_rows, self.records.size_bytes >> 20))
+
+        if self.dedup_policy != 'none':
+            with metrics.timer('flush_stage_duration', stream=self.stream, stage='dedup_keys'):
+                table = dedup.deduplicate(table, self.key_properties, self.dedup_policy)
+            metrics.increment('records_dropped_dedup', self.records.num_rows - table.num_rows, stream=self.stream)
+        self.records = columnar.ColumnarBuffer(self.schema, self.memory_budget_mb, self.types,
+                                               self.partition_field)
+        self.first_append = None
+        self.validator.reset()
+        return table
+
+
+class BufferManager:
+    """Keeps an independent buffer per stream. Each stream is flushed based on
+    its own size threshold: `stream_max_temp_file_size_mb` overrides the
+    global `max_temp_file_size_mb` for the streams it lists."""
+
+    def __init__(self, config):
+        self.config = config
+        self.default_max_size_mb = config.get('max_temp_file_size_mb', 1000)
+        self.stream_max_size_mb = config.get('stream_max_temp_file_size_mb') or {}
+        self.key_path_cache = KeyPathCache(config.get('flatten_cache_size', 10000))
+        # Rows of a batch sharing their key_properties are deduplicated when
+        # the batch is sealed, by default only along with record_unique_field
+        self.dedup_policy = dedup.check_policy(
+            config.get('dedup_policy', 'last' if config.get('record_unique_field') else 'none'))
+        self.buffers = {}
+
+    def __contains__(self, stream):
+        return stream in self.buffers
+
+    def get(self, stream):
+        return self.buffers[stream]
+
+    def set_schema(self, stream, schema, key_properties):
+        """Registers the schema of a stream. Returns the records buffered under
+        the previous schema of the stream when the schema changed, because column
+        types are taken from the schema."""
+        previous = self.buffers.get(stream)
+        if previous is not None and previous.schema == schema:
+            previous.key_properties = key_properties
+            return None
+
+        max_size_mb = self.stream_max_size_mb.get(stream, self.default_max_size_mb)
+        validator = RecordValidator(schema,
+                                    self.config.get('validation_mode', 'full'),
+                                    self.config.get('validation_sample_rate', 100),
+                                    self.config.get('validation_first_n', 1000))
+        flattener = RecordFlattener(stream, schema, self.key_path_cache)
+        self.buffers[stream] = StreamBuffer(stream, schema, key_properties, max_size_mb, validator, flattener,
+                                            self.config.get('buffer_memory_mb', 256),
+                                            self.dedup_policy,
+                                            self.config.get('field_to_partition_by_time'))
+        if previous is not None and previous.num_rows > 0:
+            return previous.seal()
+        return None
+
+    def close(self):
+        """Drops the buffered records and their spill files"""
+        for buffer in self.buffers.values():
+            buffer.records.clear()
+
+    def drain(self):
+        """Seals every non empty buffer, returns (stream, table) pairs"""
+        for stream, buffer in self.buffers.items():
+            if buffer.num_rows > 0:
+                yield stream, buffer.seal()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import collections
+import time
+
+import singer
+
+logger = singer.get_logger()
+
+
+class StateCheckpoints:
+    """Tracks which STATE messages are safe to emit.
+
+    A STATE is safe once every record received before it is durable in S3:
+    the batches sealed before it, and the batches that will hold the records
+    still buffered when it was received. Batches are identified by their
+    FlushPipeline sequence number, and batches are durable up to a sequence
+    number given by the caller.
+
+    A STATE pending for more than `interval` seconds is overdue: the caller
+    seals the buffers it waits on and finishes the files holding its
+    batches, so STATE messages keep being emitted while files are open."""
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        # [state, streams whose next batch is awaited, highest batch awaited, when received]
+        self.pending = collections.deque()
+        self.sealed_batch = 0
+
+    def add(self, state, buffered_streams):
+        """Registers a STATE received while `buffered_streams` had buffered records"""
+        waiting = set(buffered_streams)
+        last = self.pending[-1] if self.pending else None
+        if last is not None and last[1] == waiting and last[2] == self.sealed_batch:
+            # Waits on the same batches as the previous STATE, which it supersedes
+            last[0] = state
+        else:
+            self.pending.append([state, waiting, self.sealed_batch, time.monotonic()])
+
+    def sealed(self, stream, batch):
+        """Registers batch number `batch`, holding the buffered records of `stream`"""
+        self.sealed_batch = batch
+        for entry in self.pending:
+            if stream in entry[1]:
+                entry[1].discard(stream)
+                entry[2] = batch
+
+    def pop_durable(self, durable_batch):
+        """Returns the latest STATE made safe by the batches up to `durable_batch`
+        being durable, None if there is no new safe STATE"""
+        state = None
+        while self.pending and not self.pending[0][1] and self.pending[0][2] <= durable_batch:
+            state = self.pending.popleft()[0]
+        return state
+
+    def overdue(self):
+        """Returns whether the oldest pending STATE is overdue"""
+        return bool(self.pending) and self.interval is not None and \
+            time.monotonic() - self.pending[0][3] >= self.interval
+
+    def overdue_streams(self):
+        """Returns the streams whose buffered records the overdue STATE waits on"""
+        return set(self.pending[0][1]) if self.overdue() else set()
+
+    def overdue_batch(self):
+        """Returns the highest batch the overdue STATE waits on once every
+        stream it waits on is sealed, None otherwise"""
+        if self.overdue() and not self.pending[0][1]:
+            return self.pending[0][2]
+        return None
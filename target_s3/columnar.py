@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+from datetime import timezone
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import singer
+from dateutil.parser import parse
+
+from target_s3 import utils
+
+logger = singer.get_logger()
+
+# Approximate in-memory cost of a non string value, used by the running size counter
+VALUE_SIZE_ESTIMATE = 8
+
+
+TIMESTAMP = pa.timestamp('us', tz='UTC')
+# Wall clock time of the partition field in the offset of each value, the
+# partition columns are derived from it. Built along with the partition
+# field and dropped once the partition columns are added.
+PARTITION_TIME = '__partition_time'
+# A date-time ending with an UTC offset, the offset is the second group
+OFFSET_PATTERN = r'^([^T ]+[T ][^Z+-]+)(Z|[+-]\d{2}:?\d{2})$'
+
+
+def arrow_type(property_schema):
+    """Maps the JSON schema of a flattened property to an arrow type.
+    Returns None when the type can't be decided from the schema and has to be
+    inferred from the values."""
+    types = set(utils.schema_types(property_schema)) - {'null'}
+    if types == {'integer', 'number'}:
+        return pa.float64()
+    if len(types) != 1:
+        return pa.string() if len(types) > 1 else None
+
+    json_type = types.pop()
+    if json_type == 'integer':
+        return pa.int64()
+    if json_type == 'number':
+        return pa.float64()
+    if json_type == 'boolean':
+        return pa.bool_()
+    if json_type == 'string':
+        string_format = property_schema.get('format')
+        if string_format == 'date-time':
+            return TIMESTAMP
+        if string_format == 'date':
+            return pa.date32()
+        return pa.string()
+    if json_type in ('array', 'object'):
+        return pa.string()
+    return None
+
+
+def arrow_types(schema):
+    """Maps every flattened column of a JSON schema to an arrow type"""
+    return {column: arrow_type(property_schema)
+            for column, property_schema in utils.flatten_schema(schema).items()}
+
+
+def to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _parse_timestamps(array):
+    """Slow path of to_timestamp for values arrow can't cast, i.e. mixed offsets"""
+    values = []
+    for value in array.to_pylist():
+        if value is not None:
+            value = parse(value)
+            value = value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        values.append(value)
+    return pa.array(values, type=TIMESTAMP)
+
+
+def to_timestamp(array):
+    """Parses a string array of date-times into UTC timestamps in a single
+    vectorized cast. Date-times without an offset are taken as UTC."""
+    try:
+        return array.cast(TIMESTAMP)
+    except pa.ArrowInvalid:
+        pass
+    try:
+        return array.cast(pa.timestamp('us')).cast(TIMESTAMP)
+    except pa.ArrowInvalid:
+        return _parse_timestamps(array)
+
+
+def to_wall_clock(array):
+    """Parses a string array of date-times into timestamps without time zone
+    holding their wall clock time, ignoring their offsets"""
+    try:
+        return pc.replace_substring_regex(array, OFFSET_PATTERN, r'\1').cast(pa.timestamp('us'))
+    except pa.ArrowInvalid:
+        return pa.array([None if value is None else parse(value).replace(tzinfo=None) for value in array.to_pylist()],
+                        type=pa.timestamp('us'))
+
+
+def to_temporal(array, type):
+    if pa.types.is_date(type):
+        try:
+            return array.cast(type)
+        except pa.ArrowInvalid:
+            return to_timestamp(array).cast(pa.timestamp('us')).cast(type)
+    return to_timestamp(array)
+
+
+def build_array(values, type=None):
+    """Builds an arrow array from a list of python values. Values that don't
+    fit the expected type are stored as strings rather than failing the flush."""
+    try:
+        if type is not None and (pa.types.is_timestamp(type) or pa.types.is_date(type)):
+            strings = pa.array(values, type=pa.string())
+            try:
+                return to_temporal(strings, type)
+            except (pa.ArrowInvalid, ValueError, OverflowError):
+                logger.warning('Unable to parse a {} column, storing values as strings'.format(type))
+                return strings
+        if type == pa.float64():
+            # Singer parses numbers with decimals as Decimal
+            values = [float(v) if isinstance(v, Decimal) else v for v in values]
+        return pa.array(values, type=type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        if type != pa.string():
+            logger.warning('Unable to build a {} column, storing values as strings'.format(type or 'typed'))
+        return pa.array([to_string(v) for v in values], type=pa.string())
+
+
+def concat_tables(tables):
+    """Concatenates tables whose columns may differ: missing columns are
+    filled with nulls and columns built with different types are stored as
+    strings"""
+    if len(tables) == 1:
+        return tables[0]
+
+    fields = {}
+    for table in tables:
+        for field in table.schema:
+            known = fields.get(field.name)
+            if known is None or known == pa.null():
+                fields[field.name] = field.type
+            elif field.type != known and field.type != pa.null():
+                fields[field.name] = pa.string()
+    schema = pa.schema(list(fields.items()))
+
+    aligned = []
+    for table in tables:
+        columns = []
+        for field in schema:
+            if field.name in table.column_names:
+                column = table.column(field.name)
+                columns.append(column if column.type == field.type else column.cast(field.type))
+            else:
+                columns.append(pa.nulls(table.num_rows, type=field.type))
+        aligned.append(pa.Table.from_arrays(columns, schema=schema))
+    return pa.concat_tables(aligned)
+
+
+class ColumnarBuffer:
+    """Accumulates flattened records column by column and builds an arrow
+    table out of them using the types defined in the stream schema.
+
+    Records are kept in memory up to `memory_budget_mb`. Past the budget the
+    records in memory are converted to arrow and spilled to an Arrow IPC file,
+    the spilled files are memory mapped back when the table is built.
+
+    `types` can be shared between the successive buffers of a stream: the
+    type a column ends up with is recorded there, so the columns inferred
+    from the values or stored as strings keep the same type across flushes.
+
+    Tables are built with the columns of the schema in a fixed order, null
+    when no record sets them, followed by the columns the schema doesn't
+    declare in sorted order, so the successive tables of a stream share
+    their schema and can be appended to the same files.
+
+    When the `partition_field` column is a timestamp, the tables also carry
+    its wall clock time in the PARTITION_TIME column."""
+
+    def __init__(self, schema, memory_budget_mb=None, types=None, partition_field=None):
+        self.schema_columns = list(utils.flatten_schema(schema))
+        self.partition_field = partition_field
+        self.types = types if types is not None else arrow_types(schema)
+        self.memory_budget_bytes = memory_budget_mb << 20 if memory_budget_mb else None
+        self.columns = {}
+        self.chunk_rows = 0
+        self.chunk_bytes = 0
+        self.tables = []
+        self.tables_bytes = 0
+        self.num_rows = 0
+        self.size_bytes = 0
+        self.spill_dir = None
+        self.spill_files = []
+
+    @property
+    def memory_bytes(self):
+        """Estimated size of the records held in memory, not spilled"""
+        return self.chunk_bytes + self.tables_bytes
+
+    def append(self, record):
+        for column in sorted(record.keys() - self.columns.keys()):
+            self.columns[column] = [None] * self.chunk_rows
+
+        size = 0
+        for column, values in self.columns.items():
+            value = record.get(column)
+            values.append(value)
+            size += len(value) if type(value) is str else VALUE_SIZE_ESTIMATE
+        self.chunk_rows += 1
+        self.chunk_bytes += size
+        self.num_rows += 1
+        self.size_bytes += size
+        self._check_budget()
+
+    def append_table(self, table):
+        """Appends records already converted to arrow, i.e. by a parse worker"""
+        self._seal_chunk()
+        self.tables.append(table)
+        self.tables_bytes += table.nbytes
+        self.num_rows += table.num_rows
+        self.size_bytes += table.nbytes
+        self._check_budget()
+
+    def _check_budget(self):
+        if self.memory_budget_bytes is not None and \
+                self.chunk_bytes + self.tables_bytes > self.memory_budget_bytes:
+            self.spill()
+
+    def _chunk_table(self):
+        names = list(self.columns.keys())
+        arrays = [build_array(self.columns[name], self.types.get(name)) for name in names]
+        table = pa.Table.from_arrays(arrays, names=names)
+        if self.partition_field in self.columns and pa.types.is_timestamp(table.column(self.partition_field).type):
+            try:
+                strings = pa.array(self.columns[self.partition_field], type=pa.string())
+                table = table.append_column(PARTITION_TIME, to_wall_clock(strings))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+                logger.warning('Unable to read the wall clock time of {}, partitioning by UTC time'.format(
+                    self.partition_field))
+        return table
+
+    def _seal_chunk(self):
+        """Converts the records appended one by one to an arrow table"""
+        if self.chunk_rows > 0:
+            table = self._chunk_table()
+            self.tables.append(table)
+            self.tables_bytes += table.nbytes
+            self.columns = {name: [] for name in self.columns}
+            self.chunk_rows = 0
+            self.chunk_bytes = 0
+
+    def spill(self):
+        """Writes the records held in memory to an Arrow IPC file"""
+        self._seal_chunk()
+        if not self.tables:
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='target-s3-spill-')
+        path = os.path.join(self.spill_dir, '{}.arrow'.format(len(self.spill_files)))
+        table = concat_tables(self.tables)
+        with pa.OSFile(path, 'wb') as sink:
+            writer = pa.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+        logger.info('Spilled {} rows, ~{} MB to {}'.format(table.num_rows, self.tables_bytes >> 20, path))
+        self.spill_files.append(path)
+        self.tables = []
+        self.tables_bytes = 0
+
+    def _read_spill_files(self):
+        tables = []
+        for path in self.spill_files:
+            # The arrays point into the memory map, which stays valid after
+            # the file is unlinked
+            tables.append(pa.ipc.open_file(pa.memory_map(path, 'r')).read_all())
+            os.remove(path)
+        os.rmdir(self.spill_dir)
+        self.spill_dir = None
+        self.spill_files = []
+        return tables
+
+    def to_table(self):
+        self._seal_chunk()
+        tables = self._read_spill_files() if self.spill_files else []
+        tables.extend(self.tables)
+        if not tables:
+            tables.append(self._chunk_table())
+        table = self._align(concat_tables(tables))
+        for field in table.schema:
+            if field.type != pa.null():
+                self.types[field.name] = field.type
+        return table
+
+    def _align(self, table):
+        """Orders the columns of a table and adds the missing ones as nulls.
+        Undeclared columns of the previous tables, recorded in `types`, are kept."""
+        declared = set(self.schema_columns)
+        names = self.schema_columns + sorted((set(table.column_names) | self.types.keys()) - declared)
+        columns = []
+        for name in names:
+            column = table.column(name) if name in table.column_names else None
+            if column is None or column.type == pa.null():
+                column = pa.nulls(table.num_rows, type=self.types.get(name) or pa.null())
+            columns.append(column)
+        return pa.Table.from_arrays(columns, names=names)
+
+    def remove_spill_files(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = None
+        self.spill_files = []
+
+    def clear(self):
+        self.remove_spill_files()
+        self.columns = {}
+        self.chunk_rows = 0
+        self.chunk_bytes = 0
+        self.tables = []
+        self.tables_bytes = 0
+        self.num_rows = 0
+        self.size_bytes = 0
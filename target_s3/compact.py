@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import io
+import json
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import singer
+
+from target_s3 import columnar
+from target_s3 import metadata
+from target_s3 import metrics
+from target_s3 import s3
+from target_s3 import utils
+
+logger = singer.get_logger()
+
+# Attempts at deleting the objects S3 failed to delete
+DELETE_ATTEMPTS = 3
+
+
+def list_partitions(s3_client, s3_bucket, stream):
+    """Returns the parquet objects of a stream grouped by partition prefix"""
+    partitions = collections.defaultdict(list)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix='{}/'.format(stream)):
+        for obj in page.get('Contents', []):
+            prefix, _, name = obj['Key'].rpartition('/')
+            # Summary files like _metadata are not data files
+            if name.endswith('.parquet') and not name.startswith('_'):
+                partitions[prefix].append(obj)
+    return partitions
+
+
+def read_object(s3_client, s3_bucket, s3_key):
+    body = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)['Body'].read()
+    return pq.read_table(io.BytesIO(body))
+
+
+def type_conflicts(tables):
+    """Returns the columns having different types in different tables"""
+    types = collections.defaultdict(set)
+    for table in tables:
+        for field in table.schema:
+            if field.type != pa.null():
+                types[field.name].add(field.type)
+    return sorted(name for name, column_types in types.items() if len(column_types) > 1)
+
+
+def delete_objects(s3_client, s3_bucket, keys):
+    """Deletes objects, retrying the keys S3 failed to delete. Returns the
+    keys that still couldn't be deleted."""
+    remaining = list(keys)
+    for attempt in range(DELETE_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(2 ** attempt)
+        errors = []
+        for start in range(0, len(remaining), 1000):
+            response = s3_client.delete_objects(Bucket=s3_bucket, Delete={
+                'Objects': [{'Key': key} for key in remaining[start:start + 1000]], 'Quiet': True})
+            errors.extend(response.get('Errors', []))
+        if not errors:
+            return []
+        logger.warning('Unable to delete {} objects, i.e. {}: {} {}'.format(
+            len(errors), errors[0].get('Key'), errors[0].get('Code'), errors[0].get('Message')))
+        remaining = [error['Key'] for error in errors]
+    return remaining
+
+
+# pylint: disable=too-many-arguments
+def write_files(s3_client, s3_bucket, prefix, table, rows_per_file, rows_per_group, compression=None,
+                encryption_type=None, encryption_key=None, parquet_options=None):
+    """Writes a table to new files of `rows_per_file` rows, returns their keys
+    once they are all uploaded. When a file fails, the files already
+    uploaded are deleted before the error is raised."""
+    new_keys = []
+    try:
+        for offset in range(0, table.num_rows, rows_per_file):
+            s3_target = '{}/{}.parquet'.format(prefix, uuid.uuid4().hex)
+            with s3.MultipartUpload(s3_client, s3_bucket, s3_target,
+                                    encryption_type=encryption_type,
+                                    encryption_key=encryption_key) as sink:
+                writer = pq.ParquetWriter(sink, table.schema, compression=compression, **(parquet_options or {}))
+                try:
+                    writer.write_table(table.slice(offset, rows_per_file), row_group_size=rows_per_group)
+                finally:
+                    writer.close()
+            new_keys.append(s3_target)
+
+        for key in new_keys:
+            s3_client.head_object(Bucket=s3_bucket, Key=key)
+    except Exception:
+        leftover = delete_objects(s3_client, s3_bucket, new_keys) if new_keys else []
+        if leftover:
+            logger.error('Unable to delete the partial compaction files of {}: {}'.format(prefix, ', '.join(leftover)))
+        raise
+    return new_keys
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def compact_partition(s3_client, s3_bucket, prefix, objects, target_file_size_mb=128, row_group_size_mb=64,
+                      compression=None, encryption_type=None, encryption_key=None, sort_by=None,
+                      parquet_options=None):
+    """Merges the objects of a partition into files of about target_file_size_mb.
+    The rows are sorted by the `sort_by` columns across the new files.
+
+    The new files are uploaded and checked before the merged objects are
+    deleted, so a failure leaves the partition with its original files. When
+    some merged objects can't be deleted, the new files are replaced by files
+    holding only the rows of the deleted objects, so no row is duplicated.
+    Partitions whose files have different types for a column are skipped.
+    Returns the number of objects replaced."""
+    keys = [obj['Key'] for obj in objects]
+    tables = [read_object(s3_client, s3_bucket, key) for key in keys]
+    conflicts = type_conflicts(tables)
+    if conflicts:
+        logger.warning('Not compacting {}: columns {} have different types in its files'.format(
+            prefix, ', '.join(conflicts)))
+        return 0
+    table = columnar.concat_tables(tables)
+    if table.num_rows == 0:
+        return 0
+    # Index in keys of the object every row comes from
+    sources = np.repeat(np.arange(len(keys)), [t.num_rows for t in tables])
+    sort_keys = [(name, 'ascending') for name in sort_by or [] if name in table.column_names]
+    if sort_keys:
+        order = pc.sort_indices(table, sort_keys=sort_keys)
+        table = table.take(order)
+        sources = sources[order.to_numpy()]
+
+    # Sizes are estimated from the compressed size of the merged objects
+    compressed_bytes = sum(obj['Size'] for obj in objects)
+    bytes_per_row = max(compressed_bytes / table.num_rows, 1)
+    rows_per_file = max(int((target_file_size_mb << 20) / bytes_per_row), 1)
+    rows_per_group = max(min(int((row_group_size_mb << 20) / bytes_per_row), rows_per_file), 1)
+    file_options = (compression, encryption_type, encryption_key, parquet_options)
+
+    new_keys = write_files(s3_client, s3_bucket, prefix, table, rows_per_file, rows_per_group, *file_options)
+    remaining = delete_objects(s3_client, s3_bucket, keys)
+    if remaining:
+        logger.error('Unable to delete {} of the {} compacted objects of {}, rewriting the compacted files '
+                     'without their rows'.format(len(remaining), len(keys), prefix))
+        deleted = np.isin(sources, [keys.index(key) for key in remaining], invert=True)
+        try:
+            replacement = write_files(s3_client, s3_bucket, prefix, table.filter(pa.array(deleted)),
+                                      rows_per_file, rows_per_group, *file_options) if deleted.any() else []
+        except Exception:
+            logger.error('Partition {} holds duplicated rows: the rows of {} are also in {}'.format(
+                prefix, ', '.join(remaining), ', '.join(new_keys)))
+            raise
+        leftover = delete_objects(s3_client, s3_bucket, new_keys)
+        if leftover:
+            raise Exception('Partition {} holds duplicated rows: unable to delete {}'.format(
+                prefix, ', '.join(leftover)))
+        logger.info('Compacted {} objects of {} into {}'.format(len(keys) - len(remaining), prefix,
+                                                                len(replacement)))
+        return len(keys) - len(remaining)
+
+    logger.info('Compacted {} objects of {} into {}'.format(len(keys), prefix, len(new_keys)))
+    return len(keys)
+
+
+# pylint: disable=too-many-arguments
+def compact_stream(s3_client, s3_bucket, stream, target_file_size_mb=128, small_file_size_mb=None,
+                   row_group_size_mb=64, workers=4, compression=None, encryption_type=None, encryption_key=None,
+                   sort_by=None, parquet_options=None, write_metadata_files=False):
+    """Compacts the small files of every partition of a stream, partitions are
+    compacted in parallel. Returns the number of objects replaced.
+
+    With `write_metadata_files` set the metadata files of the stream are
+    rewritten once its partitions are compacted."""
+    if small_file_size_mb is None:
+        small_file_bytes = (target_file_size_mb << 20) // 2
+    else:
+        small_file_bytes = small_file_size_mb << 20
+    candidates = {}
+    for prefix, objects in list_partitions(s3_client, s3_bucket, stream).items():
+        small = [obj for obj in objects if obj['Size'] < small_file_bytes]
+        if len(small) > 1:
+            candidates[prefix] = small
+    logger.info('Compacting {} partitions of stream {}'.format(len(candidates), stream))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(compact_partition, s3_client, s3_bucket, prefix, objects,
+                                   target_file_size_mb, row_group_size_mb, compression,
+                                   encryption_type, encryption_key, sort_by, parquet_options)
+                   for prefix, objects in sorted(candidates.items())]
+        replaced = sum(future.result() for future in futures)
+
+    if write_metadata_files:
+        metadata.write_metadata_files(s3_client, s3_bucket, stream, encryption_type=encryption_type,
+                                      encryption_key=encryption_key, workers=workers)
+    return replaced
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='target-s3 compact',
+                                     description='Merges the small parquet files of the partitions of streams')
+    parser.add_argument('-c', '--config', help='Config file')
+    parser.add_argument('-s', '--stream', action='append', required=True, help='Stream to compact, repeatable')
+    parser.add_argument('--target-file-size-mb', type=int, help='Size of the compacted files')
+    parser.add_argument('--small-file-size-mb', type=int,
+                        help='Files smaller than this are compacted (Default: half the target file size)')
+    parser.add_argument('--row-group-size-mb', type=int, default=64, help='Size of the row groups')
+    parser.add_argument('--workers', type=int, default=4, help='Partitions compacted in parallel')
+    args = parser.parse_args(argv)
+
+    if args.config:
+        with open(args.config) as input_json:
+            config = json.load(input_json)
+    else:
+        config = {}
+
+    config_errors = utils.validate_config(config)
+    if len(config_errors) > 0:
+        logger.error("Invalid configuration:\n   * {}".format('\n   * '.join(config_errors)))
+        sys.exit(1)
+
+    run_metrics = metrics.start(config)
+    s3_client = s3.create_client(config)
+    for stream in args.stream:
+        compact_stream(s3_client, config.get('s3_bucket'), stream,
+                       args.target_file_size_mb or config.get('target_file_size_mb', 128),
+                       args.small_file_size_mb,
+                       args.row_group_size_mb,
+                       args.workers,
+                       utils.parquet_compression(config.get('compression')),
+                       config.get('encryption_type'),
+                       config.get('encryption_key'),
+                       config.get('sort_by'),
+                       {'data_page_size': (config['data_page_size_kb'] << 10
+                                           if config.get('data_page_size_kb') else None),
+                        'use_dictionary': config.get('use_dictionary', True)},
+                       config.get('write_metadata_files', False))
+    run_metrics.close()
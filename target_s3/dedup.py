@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import singer
+
+logger = singer.get_logger()
+
+DIGEST_SIZE = 16
+BLOOM_HASHES = 7
+# Digest table slots, an all zero slot is empty
+EMPTY_SLOT = bytes(DIGEST_SIZE)
+INITIAL_SLOTS = 1 << 16
+MAX_LOAD = 0.5
+# Bytes of the previous table read at once when the table grows
+GROW_CHUNK_SIZE = 1 << 20
+
+POLICIES = ('first', 'last', 'none')
+SEQUENCE_COLUMN = '_sdc_sequence'
+
+
+def check_policy(policy):
+    if policy not in POLICIES:
+        raise NotImplementedError(
+            "Deduplication policy '{}' is not supported. Expected one of: {}".format(policy, ', '.join(POLICIES)))
+    return policy
+
+
+def deduplicate(table, key_properties, policy='last'):
+    """Keeps a single row per key_properties value in a batch.
+
+    Rows are ordered by their `_sdc_sequence` when the table has it, rows
+    without a sequence rank with the oldest, and by arrival otherwise. `last` keeps the
+    latest row of every key, `first` the earliest and `none` keeps every row.
+    Only the key columns are hashed. The kept rows stay in arrival order."""
+    check_policy(policy)
+    keys = [key for key in key_properties or [] if key in table.column_names]
+    if policy == 'none' or not keys or table.num_rows < 2:
+        return table
+
+    order = None
+    keyed = table.select(keys)
+    sequence = table.column(SEQUENCE_COLUMN) if SEQUENCE_COLUMN in table.column_names else None
+    if sequence is not None and sequence.null_count < len(sequence):
+        # sort_indices is stable, rows with the same sequence stay in arrival order
+        sequence = pc.fill_null(sequence, pc.min(sequence))
+        order = pc.sort_indices(sequence)
+        keyed = keyed.take(order)
+    keyed = keyed.append_column('__position', pa.array(np.arange(table.num_rows, dtype=np.int64)))
+
+    aggregation = 'max' if policy == 'last' else 'min'
+    grouped = keyed.group_by(keys).aggregate([('__position', aggregation)])
+    if grouped.num_rows == table.num_rows:
+        return table
+    kept = grouped.column('__position_{}'.format(aggregation)).to_numpy()
+    if order is not None:
+        kept = order.to_numpy()[kept]
+    return table.take(pa.array(np.sort(kept)))
+
+
+def digest(key):
+    """Fixed size hash of a record_unique_field value. repr keeps 1 and '1' apart."""
+    key_digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+    # An all zero digest would read as an empty slot of the DigestTable
+    return key_digest if key_digest != EMPTY_SLOT else b'\x01' + key_digest[1:]
+
+
+class BloomFilter:
+    """Bloom filter over key digests, sized to a fixed number of bytes. It
+    never returns false negatives, its false positive rate grows with the
+    number of keys added once it goes past its capacity."""
+
+    def __init__(self, size_bytes):
+        self.bits = np.zeros(max(size_bytes, 1), dtype=np.uint8)
+        self.size_bits = np.uint64(len(self.bits) * 8)
+
+    def _positions(self, digests):
+        hashes = np.frombuffer(b''.join(digests), dtype='<u8').reshape(-1, 2)
+        steps = np.arange(BLOOM_HASHES, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (hashes[:, :1] + steps * hashes[:, 1:]) % self.size_bits
+
+    def add(self, digests):
+        if digests:
+            positions = self._positions(digests).ravel()
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+    def might_contain(self, digests):
+        if not digests:
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(digests)
+        set_bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+
+class DigestTable:
+    """Set of key digests in a memory mapped file, laid out as an open
+    addressing hash table with linear probing. A lookup reads a few slots
+    whatever the number of digests stored. The table doubles once it is
+    `MAX_LOAD` full, so adding a digest costs O(1) amortized."""
+
+    def __init__(self, path, slots=INITIAL_SLOTS):
+        self.path = path
+        self.size = 0
+        self.file = None
+        self.map = None
+        self._allocate(slots)
+
+    def _allocate(self, slots):
+        with open(self.path, 'wb') as f:
+            f.truncate(slots * DIGEST_SIZE)
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.slots = slots
+        self.mask = slots - 1
+
+    def _find(self, key_digest):
+        """Returns the offset of the slot holding the digest, or of the empty
+        slot ending its probe sequence, and whether the digest was found"""
+        slot = int.from_bytes(key_digest[:8], 'little') & self.mask
+        while True:
+            offset = slot * DIGEST_SIZE
+            stored = self.map[offset:offset + DIGEST_SIZE]
+            if stored == key_digest:
+                return offset, True
+            if stored == EMPTY_SLOT:
+                return offset, False
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, key_digest):
+        return self._find(key_digest)[1]
+
+    def add(self, key_digest):
+        """Adds a digest, returns False if it was already there"""
+        offset, found = self._find(key_digest)
+        if found:
+            return False
+        self.map[offset:offset + DIGEST_SIZE] = key_digest
+        self.size += 1
+        if self.size > self.slots * MAX_LOAD:
+            self._grow()
+        return True
+
+    def _grow(self):
+        previous_path, previous_file, previous_map = self.path + '.old', self.file, self.map
+        os.replace(self.path, previous_path)
+        self._allocate(self.slots * 2)
+        for start in range(0, len(previous_map), GROW_CHUNK_SIZE):
+            chunk = previous_map[start:start + GROW_CHUNK_SIZE]
+            slots = np.frombuffer(chunk, dtype=np.uint64).reshape(-1, 2)
+            for slot in np.flatnonzero(slots.any(axis=1)):
+                key_digest = chunk[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE]
+                offset = self._find(key_digest)[0]
+                self.map[offset:offset + DIGEST_SIZE] = key_digest
+        previous_map.close()
+        previous_file.close()
+        os.remove(previous_path)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class DedupIndex:
+    """Index of the record_unique_field values already uploaded for a stream.
+
+    A bloom filter in memory answers most lookups, the digests of every key
+    are kept on disk in a DigestTable which is only probed for the keys the
+    bloom filter reports as possible matches. Checking a batch costs
+    O(batch) in time and memory whatever the number of keys seen so far."""
+
+    def __init__(self, directory, max_memory_mb=64):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.bloom = BloomFilter(max_memory_mb << 20)
+        self.digests = DigestTable(os.path.join(directory, 'digests.bin'))
+
+    @property
+    def size(self):
+        return self.digests.size
+
+    def contains(self, keys):
+        """Returns a list of booleans telling which keys were already added"""
+        digests = [digest(k) for k in keys]
+        return [bool(maybe) and key_digest in self.digests
+                for key_digest, maybe in zip(digests, self.bloom.might_contain(digests))]
+
+    def add(self, keys):
+        """Adds keys that are not in the index yet"""
+        digests = [key_digest for key_digest in {digest(k) for k in keys} if self.digests.add(key_digest)]
+        self.bloom.add(digests)
+
+    def close(self):
+        self.digests.close()
+
+
+class DedupStore:
+    """Dedup indexes of a single run, one per stream, kept in a private
+    temporary directory so concurrent runs don't share state"""
+
+    def __init__(self, max_memory_mb=64, base_dir=None):
+        self.max_memory_mb = max_memory_mb
+        self.directory = tempfile.mkdtemp(prefix='target-s3-dedup-', dir=base_dir)
+        self.indexes = {}
+
+    def index(self, stream):
+        if stream not in self.indexes:
+            directory = os.path.join(self.directory, hashlib.md5(stream.encode('utf-8')).hexdigest())
+            self.indexes[stream] = DedupIndex(directory, self.max_memory_mb)
+        return self.indexes[stream]
+
+    def close(self):
+        for index in self.indexes.values():
+            index.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.indexes = {}
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import collections
+import json
+
+import singer
+
+from target_s3 import utils
+
+logger = singer.get_logger()
+
+_MISSING = object()
+
+
+class KeyPathCache:
+    """LRU cache of the column names of nested key paths, keyed by stream and path"""
+
+    def __init__(self, max_size=10000, sep='__'):
+        self.max_size = max_size
+        self.sep = sep
+        self.names = collections.OrderedDict()
+
+    def get(self, stream, path):
+        key = (stream, path)
+        name = self.names.get(key)
+        if name is None:
+            name = utils.flatten_key(path[-1], list(path[:-1]), self.sep)
+            self.names[key] = name
+            if len(self.names) > self.max_size:
+                self.names.popitem(last=False)
+        else:
+            self.names.move_to_end(key)
+        return name
+
+
+class RecordFlattener:
+    """Flattens the records of a stream like utils.flatten_record does.
+
+    The key paths declared in the stream schema are compiled into a function
+    assigning every value straight to its precomputed column name. Keys the
+    schema doesn't declare go through a generic flattener whose column names
+    are looked up in a KeyPathCache. Unlike flatten_record the columns are
+    not sorted, ColumnarBuffer orders the columns it creates."""
+
+    def __init__(self, stream, schema, cache=None):
+        self.stream = stream
+        self.cache = cache or KeyPathCache()
+        self.flatten = self._compile(schema)
+
+    @property
+    def sep(self):
+        return self.cache.sep
+
+    def _put(self, out, path, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self._put(out, path + (k,), v)
+        elif type(value) is list:
+            out[self.cache.get(self.stream, path)] = json.dumps(value)
+        else:
+            out[self.cache.get(self.stream, path)] = value
+
+    def _rest(self, out, d, known, path):
+        for k, v in d.items():
+            if k not in known:
+                self._put(out, path + (k,), v)
+
+    def _compile(self, schema):
+        namespace = {'_MISSING': _MISSING, '_dumps': json.dumps, '_put': self._put, '_rest': self._rest}
+        lines = ['def flatten(record):', '    out = {}']
+        self._emit(lines, namespace, schema.get('properties') or {}, (), 'record', 0, '    ')
+        lines.append('    return out')
+        exec(compile('\n'.join(lines), '<flattener {}>'.format(self.stream), 'exec'), namespace)
+        return namespace['flatten']
+
+    # pylint: disable=too-many-arguments
+    def _emit(self, lines, namespace, properties, path, var, depth, indent):
+        value, found = 'v{}'.format(depth), 'found{}'.format(depth)
+        known = '_known_{}'.format(len(namespace))
+        namespace[known] = frozenset(properties)
+        lines.append('{}{} = 0'.format(indent, found))
+        for key in sorted(properties):
+            key_path = path + (key,)
+            name = utils.flatten_key(key, list(path), self.sep)
+            lines.append('{}{} = {}.get({!r}, _MISSING)'.format(indent, value, var, key))
+            lines.append('{}if {} is not _MISSING:'.format(indent, value))
+            lines.append('{}    {} += 1'.format(indent, found))
+            property_schema = properties[key]
+            inner = indent + '    '
+            if 'object' in utils.schema_types(property_schema) and property_schema.get('properties'):
+                lines.append('{}if type({}) is dict:'.format(inner, value))
+                self._emit(lines, namespace, property_schema['properties'], key_path, value, depth + 1,
+                           inner + '    ')
+                lines.append('{}else:'.format(inner))
+                inner += '    '
+                lines.append('{}_put(out, {!r}, {})'.format(inner, key_path, value))
+            else:
+                lines.append('{}if type({}) is list:'.format(inner, value))
+                lines.append('{}    out[{!r}] = _dumps({})'.format(inner, name, value))
+                lines.append('{}elif type({}) is dict:'.format(inner, value))
+                lines.append('{}    _put(out, {!r}, {})'.format(inner, key_path, value))
+                lines.append('{}else:'.format(inner))
+                lines.append('{}    out[{!r}] = {}'.format(inner, name, value))
+        lines.append('{}if {} != len({}):'.format(indent, found, var))
+        lines.append('{}    _rest(out, {}, {}, {!r})'.format(indent, var, known, path))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import singer
+
+logger = singer.get_logger()
+
+
+class FlushPipeline:
+    """Runs sealed batches on a bounded pool of background workers so the
+    main loop can keep reading messages while a batch is converted and uploaded.
+
+    At most `max_pending` batches are in flight, `submit` blocks when the
+    limit is reached, which applies backpressure to the reader. Batches are
+    numbered in submission order and `landed` only counts the batches that
+    completed together with every batch submitted before them. With
+    `max_workers` set to 0 batches are flushed inline."""
+
+    def __init__(self, max_workers=2, max_pending=None):
+        self.executor = None
+        if max_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='target-s3-flush')
+        self.slots = threading.BoundedSemaphore(max_pending or max(max_workers, 1))
+        self.pending = collections.deque()
+        self.submitted = 0
+        self.landed = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.collect()
+        if self.executor is None:
+            future = Future()
+            future.set_result(fn(*args, **kwargs))
+        else:
+            self.slots.acquire()
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except Exception:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda f: self.slots.release())
+
+        self.pending.append(future)
+        self.submitted += 1
+        return self.submitted
+
+    def collect(self):
+        """Advances `landed` over the completed batches, in submission order.
+        Raises the error of a failed batch."""
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+            self.landed += 1
+        return self.landed
+
+    def wait(self):
+        """Blocks until every submitted batch has landed"""
+        while self.pending:
+            self.pending[0].result()
+            self.collect()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import json
+import re
+
+import singer
+
+logger = singer.get_logger()
+
+# Singer taps write the message type first, i.e. {"type": "RECORD", ...}
+TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"(\w+)"')
+
+CODECS = {'json': json.loads}
+try:
+    import orjson
+    CODECS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+    CODECS['ujson'] = ujson.loads
+except ImportError:
+    pass
+try:
+    import simplejson
+    CODECS['simplejson'] = simplejson.loads
+except ImportError:
+    pass
+
+# Codecs decoding integers of any size exactly, tried by 'auto' fastest
+# first. orjson and ujson turn integers beyond 64 bits into floats or reject
+# them, they are only used when configured.
+EXACT_CODECS = ('json',)
+
+
+def sniff_type(line):
+    """Returns the type of a message without decoding it, or None when the
+    type is not the first key of the message"""
+    match = TYPE_PATTERN.match(line)
+    return match.group(1) if match else None
+
+
+def get_codec(name='auto'):
+    if name == 'auto':
+        name = next(codec for codec in EXACT_CODECS if codec in CODECS)
+    if name not in CODECS:
+        raise NotImplementedError(
+            "JSON codec '{}' is not available. Expected one of: {}".format(name, sorted(CODECS)))
+    return name, CODECS[name]
+
+
+class MessageDecoder:
+    """Decodes Singer messages straight to dicts shaped like
+    singer.parse_message(...).asdict(), without building Message objects.
+
+    RECORD messages, the bulk of the input, are decoded with the configured
+    codec. The other messages, and the records the codec rejects, like the
+    NaN and Infinity the standard library writes, are decoded with the
+    standard library."""
+
+    def __init__(self, codec='auto'):
+        self.codec, self.loads = get_codec(codec)
+
+    def decode(self, line):
+        try:
+            if sniff_type(line) in ('RECORD', None) and self.loads is not json.loads:
+                try:
+                    o = self.loads(line)
+                except ValueError:
+                    o = json.loads(line)
+            else:
+                o = json.loads(line)
+        except ValueError:
+            logger.error("Unable to parse:\n{}".format(line))
+            raise
+        if not isinstance(o, dict) or 'type' not in o:
+            raise Exception("Message must be an object with a type: {}".format(line))
+        return o
+
+    def decode_all(self, messages):
+        for message in messages:
+            yield self.decode(message)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow.parquet as pq
+import singer
+
+from target_s3 import s3
+
+logger = singer.get_logger()
+
+COMMON_METADATA = '_common_metadata'
+METADATA = '_metadata'
+
+
+class S3ObjectFile(io.RawIOBase):
+    """Seekable read only file over an S3 object, reads are ranged GET requests.
+    Enough for pyarrow to read a parquet footer without downloading the file."""
+
+    def __init__(self, s3_client, bucket, s3_key, size):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_key = s3_key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        data = self._get_range(self.position, end - 1)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    @s3.retry_pattern()
+    def _get_range(self, start, end):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.s3_key,
+                                             Range='bytes={}-{}'.format(start, end))
+        return response['Body'].read()
+
+
+def read_footer(s3_client, bucket, obj):
+    return pq.read_metadata(S3ObjectFile(s3_client, bucket, obj['Key'], obj['Size']))
+
+
+def _upload(s3_client, bucket, s3_key, write, encryption_type=None, encryption_key=None):
+    with s3.MultipartUpload(s3_client, bucket, s3_key,
+                            encryption_type=encryption_type, encryption_key=encryption_key) as sink:
+        write(sink)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def write_metadata_files(s3_client, bucket, stream, known=None, encryption_type=None, encryption_key=None,
+                         workers=8):
+    """Writes the `_common_metadata` and `_metadata` summary files of a stream.
+
+    `_common_metadata` holds the schema of the most recent file of the stream,
+    `_metadata` the row groups of every file of the stream, so engines can
+    plan queries without opening every footer. The footers of the files are
+    read from S3 unless given in `known`, a dict of FileMetaData by key.
+
+    When the files don't all have the same schema no `_metadata` can describe
+    them, a stale `_metadata` is deleted instead."""
+    known = known or {}
+    prefix = '{}/'.format(stream)
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'].rpartition('/')[2]
+            if name.endswith('.parquet') and not name.startswith('_'):
+                objects.append(obj)
+    if not objects:
+        return
+
+    objects.sort(key=lambda obj: (obj['LastModified'], obj['Key']))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        footers = list(executor.map(
+            lambda obj: known.get(obj['Key']) or read_footer(s3_client, bucket, obj), objects))
+
+    schema = footers[-1].schema
+    _upload(s3_client, bucket, prefix + COMMON_METADATA,
+            lambda sink: pq.write_metadata(schema.to_arrow_schema(), sink),
+            encryption_type, encryption_key)
+
+    if not all(footer.schema.equals(schema) for footer in footers):
+        logger.warning('The files of stream {} have different schemas, not writing {}'.format(stream, METADATA))
+        s3_client.delete_object(Bucket=bucket, Key=prefix + METADATA)
+        return
+
+    metadata = None
+    for obj, footer in zip(objects, footers):
+        footer.set_file_path(obj['Key'][len(prefix):])
+        if metadata is None:
+            metadata = footer
+        else:
+            metadata.append_row_groups(footer)
+    _upload(s3_client, bucket, prefix + METADATA, metadata.write_metadata_file, encryption_type, encryption_key)
+    logger.info('Wrote {} of stream {}: {} files, {} row groups'.format(
+        METADATA, stream, len(objects), metadata.num_row_groups))
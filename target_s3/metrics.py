@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import collections
+import contextlib
+import cProfile
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import singer
+from singer import metrics as singer_metrics
+
+logger = singer.get_logger()
+
+PROMETHEUS_PREFIX = 'target_s3_'
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+
+def _key(name, tags):
+    return name, tuple(sorted(tags.items()))
+
+
+def _prometheus_labels(tags):
+    if not tags:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        re.sub(r'\W', '_', k), str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in tags))
+
+
+class Metrics:
+    """Counters and timers of a run.
+
+    Counters are logged as Singer metric lines every `log_interval` seconds
+    with the increment since the previous line, like singer.metrics.Counter
+    does. Every timer observation is logged as a Singer timer line when it
+    is made. When `prometheus_file` is set the totals are also written to
+    it in the Prometheus textfile format, replaced atomically.
+
+    `profile` dumps a profile of every flush to `profile_dir`: `cprofile`
+    writes pstats files, `tracemalloc` writes memory snapshots."""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, log_interval=singer_metrics.DEFAULT_LOG_INTERVAL, prometheus_file=None, profile=None,
+                 profile_dir=None):
+        if profile is not None and profile not in PROFILE_MODES:
+            raise NotImplementedError(
+                "Profile mode '{}' is not supported. Expected one of: {}".format(profile, ', '.join(PROFILE_MODES)))
+        self.log_interval = log_interval
+        self.prometheus_file = prometheus_file
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.counters = collections.defaultdict(float)
+        self.logged_counters = {}
+        # (name, tags) -> [count, total seconds]
+        self.timers = {}
+        self.profiles = 0
+        self.last_log = time.monotonic()
+        self.lock = threading.Lock()
+
+        if profile is not None:
+            self.profile_dir = profile_dir or tempfile.mkdtemp(prefix='target-s3-profiles-')
+            os.makedirs(self.profile_dir, exist_ok=True)
+            logger.info('Dumping a {} profile of every flush to {}'.format(profile, self.profile_dir))
+            if profile == 'tracemalloc' and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def increment(self, name, value=1, **tags):
+        key = _key(name, tags)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, seconds, **tags):
+        key = _key(name, tags)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+        singer_metrics.log(logger, singer_metrics.Point('timer', name, seconds, tags))
+
+    @contextlib.contextmanager
+    def timer(self, name, **tags):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **tags)
+
+    def profiled(self, name, fn, *args, **kwargs):
+        """Calls fn, dumping its profile as `name` when profiling is enabled"""
+        if self.profile is None:
+            return fn(*args, **kwargs)
+
+        with self.lock:
+            self.profiles += 1
+            path = os.path.join(self.profile_dir, '{:05d}-{}'.format(self.profiles, re.sub(r'[^\w.-]', '_', name)))
+        if self.profile == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(fn, *args, **kwargs)
+            finally:
+                profile.dump_stats(path + '.prof')
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            tracemalloc.take_snapshot().dump(path + '.tracemalloc')
+            current, peak = tracemalloc.get_traced_memory()
+            logger.info('Traced memory after {}: {} MB, peak {} MB'.format(name, current >> 20, peak >> 20))
+
+    def maybe_log(self):
+        """Logs the counters if `log_interval` seconds passed since they were last logged"""
+        if time.monotonic() - self.last_log >= self.log_interval:
+            self.log()
+
+    def log(self):
+        with self.lock:
+            self.last_log = time.monotonic()
+            counters = dict(self.counters)
+            timers = {key: list(timer) for key, timer in self.timers.items()}
+        for (name, tags), value in sorted(counters.items()):
+            increment = value - self.logged_counters.get((name, tags), 0)
+            if increment:
+                singer_metrics.log(logger, singer_metrics.Point('counter', name, increment, dict(tags)))
+        self.logged_counters = counters
+        if self.prometheus_file:
+            self.write_prometheus(counters, timers)
+
+    def write_prometheus(self, counters, timers):
+        lines = []
+        names = set()
+        for (name, tags), value in sorted(counters.items()):
+            metric = '{}{}_total'.format(PROMETHEUS_PREFIX, name)
+            if metric not in names:
+                names.add(metric)
+                lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{}{} {}'.format(metric, _prometheus_labels(tags), value))
+        for (name, tags), (count, total) in sorted(timers.items()):
+            metric = '{}{}'.format(PROMETHEUS_PREFIX, name)
+            if metric not in names:
+                names.add(metric)
+                lines.append('# TYPE {} summary'.format(metric))
+            labels = _prometheus_labels(tags)
+            lines.append('{}_count{} {}'.format(metric, labels, count))
+            lines.append('{}_sum{} {}'.format(metric, labels, total))
+
+        temp_file = '{}.{}.tmp'.format(self.prometheus_file, os.getpid())
+        with open(temp_file, 'w') as prom:
+            prom.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, self.prometheus_file)
+
+    def close(self):
+        self.log()
+        if self.profile == 'tracemalloc':
+            tracemalloc.stop()
+
+
+# Metrics of the current run. Code without access to the run, like the
+# backoff handlers, records to it through the module functions.
+_current = Metrics()
+
+
+def start(config):
+    """Starts the metrics of a run configured by `config`, returns them"""
+    global _current  # pylint: disable=global-statement
+    _current = Metrics(config.get('metrics_log_interval', singer_metrics.DEFAULT_LOG_INTERVAL),
+                       config.get('metrics_prometheus_file'),
+                       config.get('profile_flushes'),
+                       config.get('profile_dir'))
+    return _current
+
+
+def current():
+    return _current
+
+
+def increment(name, value=1, **tags):
+    _current.increment(name, value, **tags)
+
+
+def observe(name, seconds, **tags):
+    _current.observe(name, seconds, **tags)
+
+
+def timer(name, **tags):
+    return _current.timer(name, **tags)
+
+
+def profiled(name, fn, *args, **kwargs):
+    return _current.profiled(name, fn, *args, **kwargs)
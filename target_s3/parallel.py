@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import multiprocessing
+import threading
+
+import singer
+
+from target_s3.buffers import BufferManager, prepare_record, prepare_schema
+from target_s3.messages import MessageDecoder, sniff_type
+
+logger = singer.get_logger()
+
+# State of a parse worker process, set up by init_worker
+_worker = {}
+
+
+def init_worker(config):
+    _worker['config'] = config
+    # A chunk is sent back as soon as it is parsed, spilling it would only
+    # leave files behind when the pool is terminated
+    _worker['buffers'] = BufferManager(dict(config, buffer_memory_mb=None))
+    _worker['decoder'] = MessageDecoder(config.get('json_codec', 'auto'))
+
+
+def _seal_records(buffers, messages):
+    for stream, buffer in buffers.buffers.items():
+        if buffer.num_rows > 0:
+            messages.append({'type': 'RECORD_BATCH', 'stream': stream, 'table': buffer.records.to_table()})
+            buffer.records.clear()
+            # A chunk is the batch of the worker, i.e. `first` validates the first records of every chunk
+            buffer.validator.reset()
+
+
+def process_lines(task):
+    """Parses, validates and flattens a chunk of lines in a worker process.
+
+    Returns the messages of the chunk in order, the records between two other
+    messages are returned as a RECORD_BATCH message per stream carrying an
+    arrow table."""
+    schemas, lines = task
+    config, buffers, decoder = _worker['config'], _worker['buffers'], _worker['decoder']
+    for stream, (schema, key_properties) in schemas.items():
+        buffers.set_schema(stream, schema, key_properties)
+
+    messages = []
+    for line in lines:
+        o = decoder.decode(line)
+        if o['type'] == 'RECORD':
+            if o['stream'] not in buffers:
+                raise Exception("A record for stream {}"
+                                "was encountered before a corresponding schema".format(o['stream']))
+            buffer = buffers.get(o['stream'])
+            buffer.append(prepare_record(o, buffer, config))
+        else:
+            _seal_records(buffers, messages)
+            messages.append(o)
+    _seal_records(buffers, messages)
+    return messages
+
+
+def _tasks(messages, config, chunk_size, slots, stopped):
+    """Cuts the input in chunks of lines. SCHEMA messages are read here so
+    every chunk carries the schemas of the streams at that point of the input."""
+    decoder = MessageDecoder(config.get('json_codec', 'auto'))
+    schemas = {}
+    lines = []
+
+    def acquire():
+        # Bounds the number of chunks read ahead, gives up when the pool stops
+        while not slots.acquire(timeout=0.1):
+            if stopped.is_set():
+                return False
+        return True
+
+    for line in messages:
+        message_type = sniff_type(line)
+        if message_type == 'SCHEMA' or (message_type is None and 'SCHEMA' in line):
+            o = decoder.decode(line)
+            if o['type'] == 'SCHEMA':
+                if lines:
+                    if not acquire():
+                        return
+                    yield dict(schemas), lines
+                    lines = []
+                schemas[o['stream']] = (prepare_schema(o, config), o['key_properties'])
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            if not acquire():
+                return
+            yield dict(schemas), lines
+            lines = []
+    if lines and acquire():
+        yield dict(schemas), lines
+
+
+def parse_messages(messages, config):
+    """Parses the input in `parse_workers` processes. Yields the messages in
+    input order, records come as RECORD_BATCH messages."""
+    workers = config.get('parse_workers')
+    chunk_size = config.get('parse_chunk_size', 5000)
+    slots = threading.BoundedSemaphore(workers * 2)
+    stopped = threading.Event()
+    logger.info('Parsing messages in {} processes, {} lines per chunk'.format(workers, chunk_size))
+
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(config,))
+    try:
+        for chunk_messages in pool.imap(process_lines, _tasks(messages, config, chunk_size, slots, stopped)):
+            slots.release()
+            yield from chunk_messages
+    finally:
+        stopped.set()
+        pool.terminate()
+        pool.join()
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
+import io
 import os
+import threading
+import time
 import backoff
-import boto3
 import singer
 from botocore.exceptions import ClientError
 
+from target_s3 import metrics
+
 LOGGER = singer.get_logger()
 
+# S3 rejects multipart upload parts smaller than 5 MB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
 
 def retry_pattern():
     return backoff.on_exception(backoff.expo,
@@ -18,10 +25,15 @@ def retry_pattern():
 
 def log_backoff_attempt(details):
     LOGGER.info("Error detected communicating with Amazon, triggering backoff: %d try", details.get("tries"))
+    metrics.increment('s3_retries', operation=details['target'].__name__)
 
 
 @retry_pattern()
 def create_client(config):
+    # boto3 takes a while to import, it's only loaded once a client is needed
+    import boto3
+    from botocore.config import Config
+
     LOGGER.info("Attempting to create AWS session")
 
     # Get the required parameters from config file and/or environment variables
@@ -41,34 +53,176 @@ def create_client(config):
     else:
         aws_session = boto3.session.Session(profile_name=aws_profile)
 
-    return aws_session.client('s3')
+    return aws_session.client('s3', config=Config(max_pool_connections=max_pool_connections(config)))
+
+
+class LazyClient:
+    """S3 client created by `create_client` on its first use, so runs that
+    upload nothing never pay for the boto3 import and session setup"""
+
+    def __init__(self, config):
+        self.config = config
+        self.client = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = create_client(self.config)
+        return getattr(self.client, name)
+
+
+def max_pool_connections(config):
+    """Connections kept open to S3, by default enough for every upload worker
+    to send `upload_max_concurrency` parts at once"""
+    return config.get('max_pool_connections') or max(
+        config.get('upload_workers', 8) * config.get('upload_max_concurrency', 4), 10)
+
+
+def transfer_config(config):
+    """Returns the boto3 TransferConfig of the uploads of local files"""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=config.get('multipart_threshold_mb', 8) << 20,
+                          multipart_chunksize=max(config.get('multipart_chunk_size_mb', 8) << 20, MIN_PART_SIZE),
+                          max_concurrency=config.get('upload_max_concurrency', 4))
+
+
+def encryption_args(encryption_type=None, encryption_key=None):
+    """Returns the extra S3 arguments and a log description of the configured encryption"""
+    if encryption_type is None or encryption_type.lower() == "none":
+        # No encryption config (defaults to settings on the bucket):
+        return None, ""
+
+    if encryption_type.lower() == "kms":
+        args = {"ServerSideEncryption": "aws:kms"}
+        if encryption_key:
+            args["SSEKMSKeyId"] = encryption_key
+            return args, " using KMS encryption key ID '{}'".format(encryption_key)
+        return args, " using default KMS encryption"
+
+    raise NotImplementedError(
+        "Encryption type '{}' is not supported. "
+        "Expected: 'none' or 'KMS'"
+        .format(encryption_type)
+    )
 
 
 # pylint: disable=too-many-arguments
 @retry_pattern()
 def upload_file(filename, s3_client, bucket, s3_key,
-                encryption_type=None, encryption_key=None):
+                encryption_type=None, encryption_key=None, transfer_config=None):
+    extra_args, encryption_desc = encryption_args(encryption_type, encryption_key)
+    LOGGER.info("Uploading {} to bucket {} at {}{}".format(filename, bucket, s3_key, encryption_desc))
+    with metrics.timer('upload_duration', mode='file'):
+        s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=extra_args, Config=transfer_config)
+    metrics.increment('upload_bytes', os.path.getsize(filename))
+    metrics.increment('objects_uploaded')
 
-    if encryption_type is None or encryption_type.lower() == "none":
-        # No encryption config (defaults to settings on the bucket):
-        encryption_desc = ""
-        encryption_args = None
-    else:
-        if encryption_type.lower() == "kms":
-            encryption_args = {"ServerSideEncryption": "aws:kms"}
-            if encryption_key:
-                encryption_desc = (
-                    " using KMS encryption key ID '{}'"
-                    .format(encryption_key)
-                )
-                encryption_args["SSEKMSKeyId"] = encryption_key
+
+class MultipartUpload(io.RawIOBase):
+    """Writable file object that uploads what is written to it as the parts of
+    an S3 multipart upload, keeping at most one part in memory. Objects smaller
+    than a single part are uploaded with a plain put_object on close."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, s3_client, bucket, s3_key, part_size=MIN_PART_SIZE,
+                 encryption_type=None, encryption_key=None):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_key = s3_key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.extra_args, self.encryption_desc = encryption_args(encryption_type, encryption_key)
+        self.buffer = io.BytesIO()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        # Time spent in S3 requests for the object
+        self.upload_seconds = 0.0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        written = self.buffer.write(data)
+        self.size += written
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+        return written
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self._put_object()
             else:
-                encryption_desc = " using default KMS encryption"
+                if self.buffer.tell() > 0:
+                    self._upload_part()
+                self._complete()
+            metrics.observe('upload_duration', self.upload_seconds, mode='multipart')
+            metrics.increment('upload_bytes', self.size)
+            metrics.increment('objects_uploaded')
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
         else:
-            raise NotImplementedError(
-                "Encryption type '{}' is not supported. "
-                "Expected: 'none' or 'KMS'"
-                .format(encryption_type)
-            )
-    LOGGER.info("Uploading {} to bucket {} at {}{}".format(filename, bucket, s3_key, encryption_desc))
-    s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=encryption_args)
+            # Don't publish a partially written object
+            self.abort()
+
+    def abort(self):
+        """Closes the file without publishing the object"""
+        if self.upload_id is not None:
+            LOGGER.info("Aborting multipart upload of {}".format(self.s3_key))
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.s3_key, UploadId=self.upload_id)
+            self.upload_id = None
+        super().close()
+
+    def _request(self, operation, **kwargs):
+        start = time.perf_counter()
+        try:
+            return getattr(self.s3_client, operation)(Bucket=self.bucket, Key=self.s3_key, **kwargs)
+        finally:
+            self.upload_seconds += time.perf_counter() - start
+
+    @retry_pattern()
+    def _put_object(self):
+        LOGGER.info("Uploading {} bytes to bucket {} at {}{}".format(
+            self.size, self.bucket, self.s3_key, self.encryption_desc))
+        self._request('put_object', Body=self.buffer.getvalue(), **(self.extra_args or {}))
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self._create()
+        part_number = len(self.parts) + 1
+        response = self._send_part(part_number, self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = io.BytesIO()
+
+    @retry_pattern()
+    def _create(self):
+        LOGGER.info("Starting multipart upload to bucket {} at {}{}".format(
+            self.bucket, self.s3_key, self.encryption_desc))
+        response = self._request('create_multipart_upload', **(self.extra_args or {}))
+        self.upload_id = response['UploadId']
+
+    @retry_pattern()
+    def _send_part(self, part_number, body):
+        return self._request('upload_part', UploadId=self.upload_id, PartNumber=part_number, Body=body)
+
+    @retry_pattern()
+    def _complete(self):
+        LOGGER.info("Completing multipart upload of {} bytes in {} parts to bucket {} at {}".format(
+            self.size, len(self.parts), self.bucket, self.s3_key))
+        self._request('complete_multipart_upload', UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
@@ -5,7 +5,7 @@ import time
 import singer
 import json
 import re
-import collections
+import collections.abc
 import inflection
 import itertools
 
@@ -30,6 +30,19 @@ def validate_config(config):
     return errors
 
 
+def parquet_compression(compression):
+    """Validates the compression config, returns the parquet compression codec"""
+    filename_sufix_map = {'snappy': 'snappy', 'gzip': 'gz', 'brotli': 'br'}
+    if compression is None or compression.lower() == "none":
+        return None
+    if compression not in filename_sufix_map:
+        raise NotImplementedError(
+            """Compression type '{}' is not supported. Expected: {}""".format(compression,
+                                                                              filename_sufix_map.keys())
+        )
+    return compression
+
+
 def float_to_decimal(value):
     """Walk the given data structure and turn all instances of float into
     double."""
@@ -112,9 +125,36 @@ def flatten_record(d, parent_key=[], sep='__'):
     for k in sorted(d.keys()):
         v = d[k]
         new_key = flatten_key(k, parent_key, sep)
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, collections.abc.MutableMapping):
             items.extend(flatten_record(v, parent_key + [k], sep=sep).items())
         else:
             items.append((new_key, json.dumps(v) if type(v) is list else v))
     return dict(items)
 
+
+def flatten_schema(d, parent_key=[], sep='__'):
+    """Flatten the properties of a JSON schema the same way flatten_record
+    flattens records, so every flattened column maps to its property schema
+    """
+    items = []
+    properties = d.get('properties') or {}
+    for k in sorted(properties.keys()):
+        v = properties[k]
+        new_key = flatten_key(k, parent_key, sep)
+        if 'object' in schema_types(v) and v.get('properties'):
+            items.extend(flatten_schema(v, parent_key + [k], sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def schema_types(property_schema):
+    """Returns the list of JSON schema types a property accepts, including
+    the ones declared in anyOf sub schemas
+    """
+    types = property_schema.get('type', [])
+    if isinstance(types, str):
+        types = [types]
+    for sub_schema in property_schema.get('anyOf', []):
+        types = types + schema_types(sub_schema)
+    return types
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import re
+from decimal import Decimal
+
+import singer
+from jsonschema import Draft4Validator, FormatChecker
+from jsonschema.exceptions import ValidationError
+
+from target_s3 import utils
+
+logger = singer.get_logger()
+
+VALIDATION_MODES = ('full', 'sample', 'first')
+
+PYTHON_TYPES = {
+    'null': (type(None),),
+    'boolean': (bool,),
+    'integer': (int,),
+    'number': (int, float, Decimal),
+    'string': (str,),
+    'array': (list,),
+    'object': (dict,),
+}
+
+# Draft 4 keywords the compiler doesn't implement, schemas using any of them
+# are validated with jsonschema instead
+UNSUPPORTED_KEYWORDS = {'$ref', 'allOf', 'oneOf', 'not', 'patternProperties', 'dependencies',
+                        'uniqueItems', 'minProperties', 'maxProperties', 'additionalItems'}
+
+FORMAT_CHECKER = FormatChecker()
+
+
+def is_supported(schema):
+    """Tells if every keyword of the schema, and of its sub schemas, can be compiled"""
+    if not isinstance(schema, dict):
+        return True
+    if UNSUPPORTED_KEYWORDS & schema.keys():
+        return False
+    sub_schemas = list((schema.get('properties') or {}).values()) + list(schema.get('anyOf') or [])
+    for key in ('items', 'additionalProperties'):
+        if isinstance(schema.get(key), dict):
+            sub_schemas.append(schema[key])
+    if isinstance(schema.get('items'), list):
+        return False
+    return all(is_supported(s) for s in sub_schemas)
+
+
+def _type_check(types):
+    python_types = tuple(t for name in types for t in PYTHON_TYPES.get(name, ()))
+    allows_bool = 'boolean' in types
+
+    def check(value, path):
+        if not isinstance(value, python_types) or (not allows_bool and isinstance(value, bool)):
+            raise ValidationError('{!r} is not of type {} at {}'.format(value, types, path))
+    return check
+
+
+def _properties_check(properties, required, additional):
+    compiled = {name: compile_schema(s) for name, s in properties.items()}
+    compiled_additional = compile_schema(additional) if isinstance(additional, dict) else None
+
+    def check(value, path):
+        if not isinstance(value, dict):
+            return
+        for name in required:
+            if name not in value:
+                raise ValidationError('{!r} is a required property at {}'.format(name, path))
+        for name, item in value.items():
+            property_check = compiled.get(name)
+            if property_check is not None:
+                property_check(item, path + [name])
+            elif additional is False:
+                raise ValidationError('Additional property {!r} is not allowed at {}'.format(name, path))
+            elif compiled_additional is not None:
+                compiled_additional(item, path + [name])
+    return check
+
+
+def _items_check(items):
+    compiled = compile_schema(items)
+
+    def check(value, path):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                compiled(item, path + [i])
+    return check
+
+
+def _multiple_of_check(multiple_of):
+    multiple_of = Decimal(str(multiple_of))
+
+    def check(value, path):
+        if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+            # Decimals are only needed here, to avoid float rounding errors.
+            # Long precisions raise decimal.InvalidOperation
+            if Decimal(str(value)) % multiple_of:
+                raise ValidationError('{!r} is not a multiple of {} at {}'.format(value, multiple_of, path))
+    return check
+
+
+def _range_check(schema):
+    minimum, maximum = schema.get('minimum'), schema.get('maximum')
+    exclusive_minimum, exclusive_maximum = schema.get('exclusiveMinimum'), schema.get('exclusiveMaximum')
+
+    def check(value, path):
+        if not isinstance(value, (int, float, Decimal)) or isinstance(value, bool):
+            return
+        if minimum is not None and (value <= minimum if exclusive_minimum else value < minimum):
+            raise ValidationError('{!r} is less than the minimum of {} at {}'.format(value, minimum, path))
+        if maximum is not None and (value >= maximum if exclusive_maximum else value > maximum):
+            raise ValidationError('{!r} is greater than the maximum of {} at {}'.format(value, maximum, path))
+    return check
+
+
+def _string_check(schema):
+    min_length, max_length = schema.get('minLength'), schema.get('maxLength')
+    pattern = re.compile(schema['pattern']) if 'pattern' in schema else None
+    string_format = schema.get('format')
+
+    def check(value, path):
+        if not isinstance(value, str):
+            return
+        if min_length is not None and len(value) < min_length:
+            raise ValidationError('{!r} is too short at {}'.format(value, path))
+        if max_length is not None and len(value) > max_length:
+            raise ValidationError('{!r} is too long at {}'.format(value, path))
+        if pattern is not None and not pattern.search(value):
+            raise ValidationError('{!r} does not match {!r} at {}'.format(value, pattern.pattern, path))
+        if string_format is not None and not FORMAT_CHECKER.conforms(value, string_format):
+            raise ValidationError('{!r} is not a {!r} at {}'.format(value, string_format, path))
+    return check
+
+
+def _array_length_check(schema):
+    min_items, max_items = schema.get('minItems'), schema.get('maxItems')
+
+    def check(value, path):
+        if not isinstance(value, list):
+            return
+        if min_items is not None and len(value) < min_items:
+            raise ValidationError('{!r} is too short at {}'.format(value, path))
+        if max_items is not None and len(value) > max_items:
+            raise ValidationError('{!r} is too long at {}'.format(value, path))
+    return check
+
+
+def _enum_check(enum):
+    def check(value, path):
+        if value not in enum:
+            raise ValidationError('{!r} is not one of {} at {}'.format(value, enum, path))
+    return check
+
+
+def _any_of_check(sub_schemas):
+    compiled = [compile_schema(s) for s in sub_schemas]
+
+    def check(value, path):
+        for sub_check in compiled:
+            try:
+                sub_check(value, path)
+                return
+            except ValidationError:
+                pass
+        raise ValidationError('{!r} is not valid under any of the given schemas at {}'.format(value, path))
+    return check
+
+
+def compile_schema(schema):
+    """Compiles a JSON schema into a function checking a value against it.
+    The function raises a ValidationError for invalid values."""
+    checks = []
+    types = schema.get('type')
+    if types is not None:
+        checks.append(_type_check([types] if isinstance(types, str) else types))
+    if 'enum' in schema:
+        checks.append(_enum_check(schema['enum']))
+    if schema.get('properties') or schema.get('required') or 'additionalProperties' in schema:
+        checks.append(_properties_check(schema.get('properties') or {}, schema.get('required') or [],
+                                        schema.get('additionalProperties', True)))
+    if isinstance(schema.get('items'), dict):
+        checks.append(_items_check(schema['items']))
+    if 'minItems' in schema or 'maxItems' in schema:
+        checks.append(_array_length_check(schema))
+    if 'multipleOf' in schema:
+        checks.append(_multiple_of_check(schema['multipleOf']))
+    if 'minimum' in schema or 'maximum' in schema:
+        checks.append(_range_check(schema))
+    if {'minLength', 'maxLength', 'pattern', 'format'} & schema.keys():
+        checks.append(_string_check(schema))
+    if schema.get('anyOf'):
+        checks.append(_any_of_check(schema['anyOf']))
+
+    if not checks:
+        return lambda value, path: None
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(value, path):
+        for c in checks:
+            c(value, path)
+    return check
+
+
+class RecordValidator:
+    """Validates the records of a stream against a schema compiled once.
+
+    Modes:
+      - full: every record is validated
+      - sample: one record every `sample_rate` records is validated
+      - first: only the first `first_n` records of every batch are validated"""
+
+    def __init__(self, schema, mode='full', sample_rate=100, first_n=1000):
+        if mode not in VALIDATION_MODES:
+            raise NotImplementedError(
+                "Validation mode '{}' is not supported. Expected: {}".format(mode, VALIDATION_MODES))
+        self.mode = mode
+        self.sample_rate = max(sample_rate, 1)
+        self.first_n = first_n
+        self.seen = 0
+        if is_supported(schema):
+            compiled = compile_schema(schema)
+            self.check = lambda record: compiled(record, [])
+        else:
+            logger.info('Schema uses keywords the validator can not compile, falling back to jsonschema')
+            validator = Draft4Validator(utils.float_to_decimal(schema), format_checker=FORMAT_CHECKER)
+            self.check = lambda record: validator.validate(utils.float_to_decimal(record))
+
+    def validate(self, record):
+        self.seen += 1
+        if self.mode == 'sample' and (self.seen - 1) % self.sample_rate:
+            return
+        if self.mode == 'first' and self.seen > self.first_n:
+            return
+        self.check(record)
+
+    def reset(self):
+        """Starts a new batch"""
+        self.seen = 0
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+import collections
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import singer
+
+from target_s3 import metadata
+from target_s3 import metrics
+from target_s3 import s3
+
+logger = singer.get_logger()
+
+GRANULARITIES = {
+    'month': ['idx_year', 'idx_month'],
+    'day': ['idx_year', 'idx_month', 'idx_day'],
+    'hour': ['idx_year', 'idx_month', 'idx_day', 'idx_hour'],
+}
+PARTITION_COLUMNS = GRANULARITIES['day']
+
+
+def partition_columns(granularity='day'):
+    if granularity not in GRANULARITIES:
+        raise NotImplementedError(
+            "Partition granularity '{}' is not supported. Expected one of: {}".format(
+                granularity, ', '.join(GRANULARITIES)))
+    return GRANULARITIES[granularity]
+
+
+def split_partitions(table, columns=None):
+    """Returns ((year, month, ...), row indices) pairs, one per partition of the table"""
+    columns = [pc.fill_null(table.column(name), 0).to_numpy().astype(np.int64)
+               for name in columns or PARTITION_COLUMNS]
+    # Packs the partition values in a single sortable key, every value but the year is below 100
+    keys = columns[0]
+    for column in columns[1:]:
+        keys = keys * 100 + column
+    order = np.argsort(keys, kind='stable')
+    bounds = np.flatnonzero(np.diff(keys[order])) + 1
+    for rows in np.split(order, bounds):
+        if len(rows):
+            yield tuple(int(column[rows[0]]) for column in columns), rows
+
+
+def partition_prefix(stream, partition, columns=None):
+    return '{}/{}'.format(stream, '/'.join('{}={}'.format(name, value)
+                                          for name, value in zip(columns or PARTITION_COLUMNS, partition)))
+
+
+def sort_table(table, sort_by):
+    """Sorts a table by the `sort_by` columns it has"""
+    sort_keys = [(name, 'ascending') for name in sort_by if name in table.column_names]
+    if not sort_keys:
+        return table
+    return table.take(pc.sort_indices(table, sort_keys=sort_keys))
+
+
+class PartitionWriter:
+    """Parquet file of a partition, open for appending row groups. `lock`
+    serializes the writes and the close of the file."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, stream, s3_target, schema, sink, compression=None, path=None, **parquet_options):
+        self.stream = stream
+        self.s3_target = s3_target
+        self.schema = schema
+        self.sink = sink
+        self.path = path
+        self.rows = 0
+        # Size of the finished file
+        self.bytes = None
+        # Lowest number of the flush batches written to the file
+        self.first_batch = None
+        # Taken out of the open writers, no more rows can be written to it
+        self.finished = False
+        self.lock = threading.Lock()
+        # Footer of the file once closed
+        self.metadata = []
+        self.writer = pq.ParquetWriter(sink, schema, compression=compression, metadata_collector=self.metadata,
+                                       **parquet_options)
+
+    @property
+    def size(self):
+        return self.sink.tell()
+
+    def write(self, table, row_group_size=None):
+        self.writer.write_table(table, row_group_size=row_group_size)
+        self.rows += table.num_rows
+
+    @property
+    def closed(self):
+        return self.bytes is not None
+
+    def close(self):
+        self.writer.close()
+        self.bytes = self.sink.tell()
+        self.sink.close()
+
+    def discard(self):
+        """Closes the file without publishing it"""
+        if isinstance(self.sink, s3.MultipartUpload):
+            self.sink.abort()
+        try:
+            self.writer.close()
+        except (ValueError, OSError, pa.ArrowException):
+            # The footer can't be written to an aborted upload
+            pass
+        self.sink.close()
+
+
+class PartitionWriterManager:
+    """Keeps a parquet writer open per (stream, year, month, day) partition so
+    successive flushes append row groups to the same file instead of creating
+    a new object per flush.
+
+    A file is finished and uploaded once it reaches `target_file_size_mb`.
+    When more than `max_open_writers` writers are open, the least recently
+    written one is finished. Every open file is finished by `close`.
+
+    In the `local` output mode the open files are kept on the local disk,
+    when they add up to more than `max_open_files_mb` the largest ones are
+    finished.
+
+    In the `local` output mode the files are written to a temporary directory
+    and uploaded when finished. In the `stream` output mode they are written
+    to S3 multipart uploads directly. The files finished together are closed
+    and uploaded concurrently by `upload_workers` threads shared by the flush
+    workers, with `upload_workers` set to 0 they are uploaded one by one.
+
+    The rows a flush appends to a file are sorted by the `sort_by` columns, so
+    the statistics of its row groups are narrow on those columns. `close`
+    writes the `_common_metadata` and `_metadata` files of the streams it
+    wrote to when `write_metadata_files` is set."""
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, s3_client, s3_bucket, compression=None, output_mode='local', part_size_mb=8,
+                 target_file_size_mb=128, max_open_writers=64, encryption_type=None, encryption_key=None,
+                 upload_workers=8, transfer_config=None, granularity='day', sort_by=None, row_group_size=None,
+                 data_page_size=None, use_dictionary=True, write_metadata_files=False, max_open_files_mb=None):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.compression = compression
+        self.output_mode = output_mode
+        self.part_size_mb = part_size_mb
+        self.target_file_size_bytes = target_file_size_mb << 20
+        self.max_open_writers = max_open_writers
+        self.max_open_files_bytes = max_open_files_mb << 20 if max_open_files_mb is not None else None
+        self.encryption_type = encryption_type
+        self.encryption_key = encryption_key
+        self.transfer_config = transfer_config
+        self.partition_columns = partition_columns(granularity)
+        self.sort_by = sort_by or []
+        self.row_group_size = row_group_size
+        self.parquet_options = {'data_page_size': data_page_size, 'use_dictionary': use_dictionary}
+        self.write_metadata_files = write_metadata_files
+        # Footers of the uploaded files by stream and key, for the metadata files
+        self.file_metadata = collections.defaultdict(dict)
+        self.executor = None
+        if upload_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix='target-s3-upload')
+        self.writers = collections.OrderedDict()
+        # Finished files not uploaded yet
+        self.uploading = set()
+        self.lock = threading.Lock()
+        self.temp_dir = tempfile.mkdtemp(prefix='target-s3-') if output_mode == 'local' else None
+
+    def _open(self, stream, partition, schema):
+        s3_target = '{}/{}.parquet'.format(partition_prefix(stream, partition, self.partition_columns),
+                                           uuid.uuid4().hex)
+        if self.output_mode == 'stream':
+            sink = s3.MultipartUpload(self.s3_client, self.s3_bucket, s3_target,
+                                      part_size=self.part_size_mb << 20,
+                                      encryption_type=self.encryption_type,
+                                      encryption_key=self.encryption_key)
+            return PartitionWriter(stream, s3_target, schema, sink, self.compression, **self.parquet_options)
+
+        path = os.path.join(self.temp_dir, s3_target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        logger.info('creating file: {}'.format(path))
+        return PartitionWriter(stream, s3_target, schema, pa.OSFile(path, 'wb'), self.compression, path,
+                               **self.parquet_options)
+
+    def _finish(self, key):
+        """Takes the writer of a partition out of the open writers, it is closed
+        and uploaded outside of the lock by _upload"""
+        writer = self.writers.pop(key)
+        writer.finished = True
+        self.uploading.add(writer)
+        return writer
+
+    def _writer(self, stream, partition, schema, batch, finished):
+        """Returns the open writer of a partition, opening one if needed. The
+        writers replaced because their schema differs are added to `finished`."""
+        key = (stream,) + partition
+        with self.lock:
+            writer = self.writers.get(key)
+            if writer is not None and writer.schema != schema:
+                finished.append(self._finish(key))
+                writer = None
+            if writer is None:
+                writer = self.writers[key] = self._open(stream, partition, schema)
+            # Concurrent flushes can write an older batch after a newer one
+            if writer.first_batch is None or (batch is not None and batch < writer.first_batch):
+                writer.first_batch = batch
+            self.writers.move_to_end(key)
+        return writer
+
+    def _upload(self, writer):
+        with writer.lock:
+            writer.close()
+        if writer.path is not None:
+            s3.upload_file(writer.path,
+                           self.s3_client,
+                           self.s3_bucket,
+                           writer.s3_target,
+                           encryption_type=self.encryption_type,
+                           encryption_key=self.encryption_key,
+                           transfer_config=self.transfer_config)
+            os.remove(writer.path)
+        with self.lock:
+            self.uploading.discard(writer)
+            if self.write_metadata_files:
+                self.file_metadata[writer.stream][writer.s3_target] = writer.metadata[0]
+        return writer.bytes
+
+    def _upload_all(self, finished):
+        """Closes and uploads finished files, concurrently when there is an upload executor"""
+        if not finished:
+            return
+        start = time.perf_counter()
+        if self.executor is None:
+            sizes = [self._upload(writer) for writer in finished]
+        else:
+            futures = [self.executor.submit(self._upload, writer) for writer in finished]
+            wait(futures)
+            sizes = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+        logger.info('Uploaded {} files, {:.1f} MB in {:.2f}s ({:.1f} MB/s)'.format(
+            len(sizes), sum(sizes) / (1 << 20), elapsed, sum(sizes) / (1 << 20) / max(elapsed, 1e-6)))
+
+    def write(self, stream, table, batch=None):
+        """Appends the rows of a table carrying the partition columns to the
+        files of their partitions. `batch` is the number of the flush batch of
+        the table, see oldest_batch.
+
+        Returns the number of parquet bytes written and of partitions written to."""
+        data = table.drop(self.partition_columns)
+        finished = []
+        written_bytes = partitions = 0
+        with metrics.timer('flush_stage_duration', stream=stream, stage='write'):
+            for partition, rows in split_partitions(table, self.partition_columns):
+                part = sort_table(data.take(pa.array(rows)), self.sort_by)
+                while True:
+                    writer = self._writer(stream, partition, data.schema, batch, finished)
+                    with writer.lock:
+                        # Another flush may have finished the writer in the meantime
+                        if writer.finished:
+                            continue
+                        size = writer.size
+                        writer.write(part, self.row_group_size)
+                        written_bytes += writer.size - size
+                        full = writer.size >= self.target_file_size_bytes
+                    break
+                partitions += 1
+                if full:
+                    with self.lock:
+                        if not writer.finished:
+                            finished.append(self._finish((stream,) + partition))
+
+            with self.lock:
+                while len(self.writers) > self.max_open_writers:
+                    finished.append(self._finish(next(iter(self.writers))))
+                if self.output_mode == 'local' and self.max_open_files_bytes is not None:
+                    open_bytes = sum(writer.size for writer in self.writers.values())
+                    while open_bytes > self.max_open_files_bytes:
+                        key = max(self.writers, key=lambda key: self.writers[key].size)
+                        open_bytes -= self.writers[key].size
+                        finished.append(self._finish(key))
+
+        self._upload_all(finished)
+        return written_bytes, partitions
+
+    def oldest_batch(self):
+        """Returns the number of the oldest flush batch with rows in a file not
+        uploaded yet, None when every written batch is uploaded"""
+        with self.lock:
+            batches = [writer.first_batch for writer in itertools.chain(self.writers.values(), self.uploading)
+                       if writer.first_batch is not None]
+        return min(batches) if batches else None
+
+    def finish_batches(self, batch):
+        """Finishes and uploads the open files holding rows of the flush
+        batches up to `batch`"""
+        with self.lock:
+            finished = [self._finish(key) for key, writer in list(self.writers.items())
+                        if writer.first_batch is not None and writer.first_batch <= batch]
+        self._upload_all(finished)
+
+    def close(self):
+        """Finishes and uploads every open file"""
+        with self.lock:
+            finished = [self._finish(key) for key in list(self.writers)]
+        self._upload_all(finished)
+        if self.write_metadata_files:
+            for stream, known in self.file_metadata.items():
+                metadata.write_metadata_files(self.s3_client, self.s3_bucket, stream, known,
+                                              self.encryption_type, self.encryption_key)
+        self.cleanup()
+
+    def abort(self):
+        """Drops the open files without uploading them"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        with self.lock:
+            for writer in itertools.chain(self.writers.values(), self.uploading):
+                if not writer.closed:
+                    writer.discard()
+            self.writers.clear()
+            self.uploading.clear()
+        self.cleanup()
+
+    def cleanup(self):
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
@@ -0,0 +1,182 @@
+import contextlib
+import io
+import json
+import os
+import threading
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+import target_s3
+from target_s3.checkpoints import StateCheckpoints
+from target_s3.flush import FlushPipeline
+
+BUCKET = 'target-s3-test'
+
+
+class FakeWriters:
+    """Stands in for PartitionWriterManager, `open_batches` are the first
+    batches of the files still open"""
+
+    def __init__(self, open_batches=()):
+        self.open_batches = set(open_batches)
+
+    def oldest_batch(self):
+        return min(self.open_batches) if self.open_batches else None
+
+    def finish_batches(self, batch):
+        self.open_batches = {first for first in self.open_batches if first > batch}
+
+
+class TestStateCheckpoints(unittest.TestCase):
+
+    def test_state_waits_for_the_batches_of_its_buffered_streams(self):
+        checkpoints = StateCheckpoints()
+        checkpoints.add({'i': 1}, ['users'])
+        self.assertIsNone(checkpoints.pop_durable(10))
+
+        checkpoints.sealed('users', 3)
+        self.assertIsNone(checkpoints.pop_durable(2))
+        self.assertEqual(checkpoints.pop_durable(3), {'i': 1})
+        self.assertIsNone(checkpoints.pop_durable(3))
+
+    def test_latest_safe_state_is_returned(self):
+        checkpoints = StateCheckpoints()
+        checkpoints.add({'i': 1}, [])
+        checkpoints.sealed('users', 1)
+        checkpoints.add({'i': 2}, ['users'])
+        checkpoints.add({'i': 3}, ['users'])
+        checkpoints.sealed('users', 2)
+
+        self.assertEqual(checkpoints.pop_durable(1), {'i': 1})
+        self.assertEqual(checkpoints.pop_durable(2), {'i': 3})
+
+    def test_overdue(self):
+        checkpoints = StateCheckpoints(interval=0)
+        self.assertFalse(checkpoints.overdue())
+        checkpoints.add({'i': 1}, ['users'])
+        self.assertEqual(checkpoints.overdue_streams(), {'users'})
+        self.assertIsNone(checkpoints.overdue_batch())
+        checkpoints.sealed('users', 4)
+        self.assertEqual(checkpoints.overdue_streams(), set())
+        self.assertEqual(checkpoints.overdue_batch(), 4)
+
+        self.assertFalse(StateCheckpoints(interval=3600).overdue())
+
+
+class TestEmitDurableState(unittest.TestCase):
+
+    def setUp(self):
+        self.emitted = []
+
+        def emit_state(state):
+            if state is not None:
+                self.emitted.append(state)
+        patcher = mock.patch('target_s3.emit_state', side_effect=emit_state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batches_landing_out_of_order(self):
+        pipeline = FlushPipeline(max_workers=2, max_pending=2)
+        self.addCleanup(pipeline.shutdown)
+        checkpoints = StateCheckpoints()
+        writers = FakeWriters()
+        first_done = threading.Event()
+
+        checkpoints.add({'i': 1}, ['users'])
+        checkpoints.sealed('users', pipeline.submitted + 1)
+        pipeline.submit(first_done.wait)
+        checkpoints.add({'i': 2}, ['events'])
+        checkpoints.sealed('events', pipeline.submitted + 1)
+        pipeline.submit(lambda: None)
+        # The second batch completes while the first one is still running
+        pipeline.pending[1].result()
+
+        target_s3.emit_durable_state(pipeline, writers, checkpoints)
+        self.assertEqual(self.emitted, [])
+
+        first_done.set()
+        pipeline.wait()
+        target_s3.emit_durable_state(pipeline, writers, checkpoints)
+        self.assertEqual(self.emitted, [{'i': 2}])
+
+    def test_open_files_hold_back_the_state(self):
+        pipeline = FlushPipeline(max_workers=0)
+        checkpoints = StateCheckpoints()
+        writers = FakeWriters([1])
+        checkpoints.add({'i': 1}, ['users'])
+        checkpoints.sealed('users', pipeline.submit(lambda: None))
+
+        target_s3.emit_durable_state(pipeline, writers, checkpoints)
+        self.assertEqual(self.emitted, [])
+
+        writers.open_batches.clear()
+        target_s3.emit_durable_state(pipeline, writers, checkpoints)
+        self.assertEqual(self.emitted, [{'i': 1}])
+
+    def test_overdue_state_finishes_the_open_files(self):
+        pipeline = FlushPipeline(max_workers=0)
+        checkpoints = StateCheckpoints(interval=0)
+        writers = FakeWriters([1, 3])
+        checkpoints.add({'i': 1}, ['users'])
+        checkpoints.sealed('users', pipeline.submit(lambda: None))
+        pipeline.submit(lambda: None)
+
+        target_s3.emit_durable_state(pipeline, writers, checkpoints)
+        self.assertEqual(self.emitted, [{'i': 1}])
+        self.assertEqual(writers.open_batches, {3})
+
+
+class FailingUploads:
+    """S3 client whose object uploads fail"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        if name in ('put_object', 'upload_part'):
+            raise RuntimeError('Upload failed')
+        return getattr(self.client, name)
+
+
+@mock_aws
+class TestPersistMessages(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+        self.messages = [json.dumps({'type': 'SCHEMA', 'stream': 'users', 'key_properties': ['id', 'created_at'],
+                                     'schema': {'properties': {'id': {'type': 'integer'},
+                                                               'created_at': {'type': 'string',
+                                                                              'format': 'date-time'}}}})]
+        for i in range(6):
+            self.messages.append(json.dumps({'type': 'RECORD', 'stream': 'users',
+                                             'record': {'id': i, 'created_at': '2021-01-0{}T00:00:00Z'.format(i + 1)}}))
+            self.messages.append(json.dumps({'type': 'STATE', 'value': {'i': i}}))
+        self.config = {'s3_bucket': BUCKET, 'field_to_partition_by_time': 'created_at', 'output_mode': 'stream',
+                       'flush_max_rows': 2, 'checkpoint_interval_seconds': 0}
+
+    def run_target(self, s3_client):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            target_s3.persist_messages(self.messages, self.config, s3_client)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_states_are_emitted_during_the_run(self):
+        states = self.run_target(self.s3_client)
+        self.assertGreater(len(states), 1)
+        self.assertEqual(states[-1], {'i': 5})
+        self.assertEqual(states, sorted(states, key=lambda state: state['i']))
+
+    def test_failing_upload_emits_no_state(self):
+        output = io.StringIO()
+        with self.assertRaises(RuntimeError), contextlib.redirect_stdout(output):
+            target_s3.persist_messages(self.messages, self.config, FailingUploads(self.s3_client))
+        self.assertEqual(output.getvalue(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
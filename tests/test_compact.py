@@ -0,0 +1,123 @@
+import io
+import json
+import os
+import unittest
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from moto import mock_aws
+
+from target_s3 import compact
+
+BUCKET = 'target-s3-test'
+PREFIX = 'users/idx_year=2021/idx_month=1/idx_day=1'
+
+
+@mock_aws
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+
+    def put_table(self, name, table):
+        sink = io.BytesIO()
+        pq.write_table(table, sink)
+        self.s3_client.put_object(Bucket=BUCKET, Key='{}/{}.parquet'.format(PREFIX, name), Body=sink.getvalue())
+
+    def read_partition(self):
+        objects = compact.list_partitions(self.s3_client, BUCKET, 'users')[PREFIX]
+        tables = [compact.read_object(self.s3_client, BUCKET, obj['Key']) for obj in objects]
+        return len(objects), pa.concat_tables(tables) if tables else None
+
+    def put_small_files(self, count=5, rows=10):
+        for i in range(count):
+            self.put_table('part-{}'.format(i), pa.table({'id': list(range(i * rows, (i + 1) * rows)),
+                                                          'name': ['n'] * rows}))
+
+    def test_compacts_small_files(self):
+        self.put_small_files()
+        replaced = compact.compact_stream(self.s3_client, BUCKET, 'users', sort_by=['id'],
+                                          write_metadata_files=True)
+
+        self.assertEqual(replaced, 5)
+        files, table = self.read_partition()
+        self.assertEqual(files, 1)
+        self.assertEqual(table.column('id').to_pylist(), list(range(50)))
+        metadata = pq.read_metadata(io.BytesIO(
+            self.s3_client.get_object(Bucket=BUCKET, Key='users/_metadata')['Body'].read()))
+        self.assertEqual(metadata.num_rows, 50)
+
+    def test_skips_partitions_with_type_conflicts(self):
+        self.put_table('a', pa.table({'id': [1, 2], 'amount': [1, 2]}))
+        self.put_table('b', pa.table({'id': [3, 4], 'amount': ['1.5', '2.5']}))
+
+        self.assertEqual(compact.compact_stream(self.s3_client, BUCKET, 'users'), 0)
+        objects = compact.list_partitions(self.s3_client, BUCKET, 'users')[PREFIX]
+        self.assertEqual(len(objects), 2)
+
+    def test_failed_deletes_leave_no_duplicated_rows(self):
+        self.put_small_files()
+        failing_key = '{}/part-3.parquet'.format(PREFIX)
+        delete_objects = self.s3_client.delete_objects
+
+        def failing_delete_objects(Bucket, Delete):
+            kept = [obj for obj in Delete['Objects'] if obj['Key'] != failing_key]
+            response = delete_objects(Bucket=Bucket, Delete=dict(Delete, Objects=kept)) if kept else {}
+            if len(kept) < len(Delete['Objects']):
+                response['Errors'] = [{'Key': failing_key, 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+            return response
+
+        self.s3_client.delete_objects = failing_delete_objects
+        compact.DELETE_ATTEMPTS, attempts = 1, compact.DELETE_ATTEMPTS
+        try:
+            replaced = compact.compact_stream(self.s3_client, BUCKET, 'users', sort_by=['id'])
+        finally:
+            compact.DELETE_ATTEMPTS = attempts
+
+        self.assertEqual(replaced, 4)
+        files, table = self.read_partition()
+        self.assertEqual(files, 2)
+        self.assertEqual(sorted(table.column('id').to_pylist()), list(range(50)))
+
+    def test_failed_upload_leaves_the_original_files(self):
+        self.put_small_files()
+        put_object = self.s3_client.put_object
+        calls = []
+
+        def failing_put_object(**kwargs):
+            calls.append(kwargs['Key'])
+            if len(calls) == 2:
+                raise RuntimeError('Upload failed')
+            return put_object(**kwargs)
+
+        self.s3_client.put_object = failing_put_object
+        with self.assertRaises(RuntimeError):
+            compact.compact_partition(self.s3_client, BUCKET, PREFIX,
+                                      compact.list_partitions(self.s3_client, BUCKET, 'users')[PREFIX],
+                                      target_file_size_mb=0)
+
+        files, table = self.read_partition()
+        self.assertEqual(files, 5)
+        self.assertEqual(sorted(table.column('id').to_pylist()), list(range(50)))
+
+    def test_main(self):
+        self.put_small_files()
+        config_path = os.path.join(os.path.dirname(__file__), 'compact_config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({'s3_bucket': BUCKET, 'aws_access_key_id': 'testing', 'aws_secret_access_key': 'testing'},
+                      config_file)
+        try:
+            compact.main(['--config', config_path, '--stream', 'users'])
+        finally:
+            os.remove(config_path)
+
+        files, table = self.read_partition()
+        self.assertEqual(files, 1)
+        self.assertEqual(table.num_rows, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+
+from target_s3 import dedup
+
+
+def colliding_digest(i):
+    """Digests sharing their first 8 bytes land in the same slot"""
+    return b'\x07' * 8 + i.to_bytes(8, 'little')
+
+
+class TestDigest(unittest.TestCase):
+
+    def test_keeps_types_apart(self):
+        self.assertNotEqual(dedup.digest(1), dedup.digest('1'))
+        self.assertEqual(len(dedup.digest(1)), dedup.DIGEST_SIZE)
+
+    def test_zero_digest_is_not_an_empty_slot(self):
+        with mock.patch('hashlib.blake2b') as blake2b:
+            blake2b.return_value.digest.return_value = dedup.EMPTY_SLOT
+            key_digest = dedup.digest('key')
+        self.assertNotEqual(key_digest, dedup.EMPTY_SLOT)
+        self.assertEqual(len(key_digest), dedup.DIGEST_SIZE)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives_past_capacity(self):
+        bloom = dedup.BloomFilter(64)
+        digests = [dedup.digest(i) for i in range(10000)]
+        bloom.add(digests)
+        self.assertTrue(bloom.might_contain(digests).all())
+
+    def test_unseen_keys_are_mostly_rejected(self):
+        bloom = dedup.BloomFilter(1 << 16)
+        bloom.add([dedup.digest(i) for i in range(1000)])
+        false_positives = bloom.might_contain([dedup.digest(i) for i in range(1000, 11000)]).sum()
+        self.assertLess(false_positives, 100)
+
+
+class TestDigestTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.table = dedup.DigestTable(os.path.join(self.directory, 'digests.bin'), slots=8)
+
+    def tearDown(self):
+        self.table.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_probes_past_collisions(self):
+        for i in range(3):
+            self.assertTrue(self.table.add(colliding_digest(i)))
+        self.assertFalse(self.table.add(colliding_digest(1)))
+        self.assertEqual(self.table.size, 3)
+        for i in range(3):
+            self.assertIn(colliding_digest(i), self.table)
+        self.assertNotIn(colliding_digest(3), self.table)
+
+    def test_grows_past_max_load(self):
+        digests = [colliding_digest(i) for i in range(3)] + [dedup.digest(i) for i in range(40)]
+        for key_digest in digests:
+            self.table.add(key_digest)
+
+        self.assertGreater(self.table.slots, 8)
+        self.assertLessEqual(self.table.size, self.table.slots * dedup.MAX_LOAD)
+        self.assertEqual(self.table.size, len(digests))
+        for key_digest in digests:
+            self.assertIn(key_digest, self.table)
+        self.assertNotIn(dedup.digest('missing'), self.table)
+        self.assertEqual(os.listdir(self.directory), ['digests.bin'])
+
+
+class TestDedupIndex(unittest.TestCase):
+
+    def test_contains_the_added_keys(self):
+        store = dedup.DedupStore(max_memory_mb=1)
+        try:
+            index = store.index('users')
+            index.add([1, 2, 2, 'a'])
+            self.assertEqual(index.size, 3)
+            self.assertEqual(index.contains([1, '1', 2, 'a', 3]), [True, False, True, True, False])
+        finally:
+            store.close()
+        self.assertFalse(os.path.exists(store.directory))
+
+
+class TestDeduplicate(unittest.TestCase):
+
+    def table(self, ids, values, sequences=None):
+        columns = {'id': ids, 'value': values}
+        if sequences is not None:
+            columns[dedup.SEQUENCE_COLUMN] = pa.array(sequences, type=pa.int64())
+        return pa.table(columns)
+
+    def test_last_keeps_the_latest_arrival_in_arrival_order(self):
+        table = self.table([1, 2, 1, 3, 2], ['a', 'b', 'c', 'd', 'e'])
+        result = dedup.deduplicate(table, ['id'], 'last')
+        self.assertEqual(result.column('id').to_pylist(), [1, 3, 2])
+        self.assertEqual(result.column('value').to_pylist(), ['c', 'd', 'e'])
+
+    def test_first_keeps_the_earliest_arrival(self):
+        table = self.table([1, 2, 1, 3, 2], ['a', 'b', 'c', 'd', 'e'])
+        result = dedup.deduplicate(table, ['id'], 'first')
+        self.assertEqual(result.column('value').to_pylist(), ['a', 'b', 'd'])
+
+    def test_none_keeps_every_row(self):
+        table = self.table([1, 1], ['a', 'b'])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'none').num_rows, 2)
+
+    def test_sequence_orders_the_rows(self):
+        table = self.table([1, 1, 2, 2], ['a', 'b', 'c', 'd'], [5, 3, 1, 2])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'last').column('value').to_pylist(), ['a', 'd'])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'first').column('value').to_pylist(), ['b', 'c'])
+
+    def test_rows_without_sequence_rank_with_the_oldest(self):
+        table = self.table([1, 1, 2, 2], ['a', 'b', 'c', 'd'], [2, None, None, 1])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'last').column('value').to_pylist(), ['a', 'd'])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'first').column('value').to_pylist(), ['b', 'c'])
+
+    def test_equal_sequences_keep_arrival_order(self):
+        table = self.table([1, 1, 1], ['a', 'b', 'c'], [1, 1, 1])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'last').column('value').to_pylist(), ['c'])
+
+    def test_all_null_sequences_fall_back_to_arrival(self):
+        table = self.table([1, 1], ['a', 'b'], [None, None])
+        self.assertEqual(dedup.deduplicate(table, ['id'], 'last').column('value').to_pylist(), ['b'])
+
+    def test_composite_keys(self):
+        table = pa.table({'id': [1, 1, 1], 'day': ['x', 'y', 'x'], 'value': ['a', 'b', 'c']})
+        result = dedup.deduplicate(table, ['id', 'day'], 'last')
+        self.assertEqual(result.column('value').to_pylist(), ['b', 'c'])
+
+    def test_missing_key_columns_keep_every_row(self):
+        table = self.table([1, 1], ['a', 'b'])
+        self.assertEqual(dedup.deduplicate(table, ['missing'], 'last').num_rows, 2)
+
+    def test_unsupported_policy(self):
+        with self.assertRaises(NotImplementedError):
+            dedup.deduplicate(self.table([1], ['a']), ['id'], 'latest')
+
+
+if __name__ == '__main__':
+    unittest.main()
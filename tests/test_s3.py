@@ -0,0 +1,135 @@
+import io
+import json
+import os
+import unittest
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from moto import mock_aws
+
+import target_s3
+from target_s3 import s3
+from target_s3.writers import PartitionWriterManager
+
+BUCKET = 'target-s3-test'
+MB = 1 << 20
+
+
+class RecordingClient:
+    """Forwards to an S3 client, recording the operations called and the size of the parts sent"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.part_sizes = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def record(**kwargs):
+            self.calls.append(name)
+            if name == 'upload_part':
+                self.part_sizes.append(len(kwargs['Body']))
+            return method(**kwargs)
+        return record
+
+
+@mock_aws
+class TestMultipartUpload(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+        self.recording = RecordingClient(self.s3_client)
+
+    def read(self, key):
+        return self.s3_client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+    def test_small_object_is_put(self):
+        with s3.MultipartUpload(self.recording, BUCKET, 'small') as sink:
+            sink.write(b'x' * 1000)
+
+        self.assertEqual(self.recording.calls, ['put_object'])
+        self.assertEqual(self.read('small'), b'x' * 1000)
+
+    def test_large_object_is_uploaded_in_parts(self):
+        data = os.urandom(12 * MB)
+        with s3.MultipartUpload(self.recording, BUCKET, 'large', part_size=1) as sink:
+            for start in range(0, len(data), MB):
+                sink.write(data[start:start + MB])
+
+        self.assertNotIn('put_object', self.recording.calls)
+        self.assertEqual(self.recording.calls.count('complete_multipart_upload'), 1)
+        self.assertEqual(self.recording.part_sizes, [5 * MB, 5 * MB, 2 * MB])
+        self.assertEqual(self.read('large'), data)
+
+    def test_error_aborts_the_upload(self):
+        with self.assertRaises(RuntimeError):
+            with s3.MultipartUpload(self.recording, BUCKET, 'aborted') as sink:
+                sink.write(b'x' * (6 * MB))
+                raise RuntimeError('Writer failed')
+
+        self.assertIn('abort_multipart_upload', self.recording.calls)
+        self.assertNotIn('Contents', self.s3_client.list_objects_v2(Bucket=BUCKET))
+        self.assertNotIn('Uploads', self.s3_client.list_multipart_uploads(Bucket=BUCKET))
+
+
+@mock_aws
+class TestStreamOutput(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+
+    def test_partition_key_layout(self):
+        messages = [json.dumps({'type': 'SCHEMA', 'stream': 'events', 'key_properties': ['id', 'created_at'],
+                                'schema': {'properties': {'id': {'type': 'integer'},
+                                                          'created_at': {'type': 'string', 'format': 'date-time'}}}})]
+        for i, created_at in enumerate(['2021-01-05T10:00:00Z', '2021-01-05T23:00:00Z', '2021-02-01T00:00:00Z']):
+            messages.append(json.dumps({'type': 'RECORD', 'stream': 'events',
+                                        'record': {'id': i, 'created_at': created_at}}))
+
+        target_s3.persist_messages(messages, {'s3_bucket': BUCKET, 'field_to_partition_by_time': 'created_at',
+                                              'output_mode': 'stream'}, self.s3_client)
+
+        keys = sorted(obj['Key'] for obj in self.s3_client.list_objects_v2(Bucket=BUCKET)['Contents'])
+        self.assertEqual(len(keys), 2)
+        self.assertRegex(keys[0], r'^events/idx_year=2021/idx_month=1/idx_day=5/[0-9a-f]{32}\.parquet$')
+        self.assertRegex(keys[1], r'^events/idx_year=2021/idx_month=2/idx_day=1/[0-9a-f]{32}\.parquet$')
+        rows = [pq.read_table(io.BytesIO(self.s3_client.get_object(Bucket=BUCKET, Key=key)['Body'].read()))
+                .column('id').to_pylist() for key in keys]
+        self.assertEqual(rows, [[0, 1], [2]])
+        self.assertNotIn('Uploads', self.s3_client.list_multipart_uploads(Bucket=BUCKET))
+
+
+@mock_aws
+class TestLocalOutput(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=BUCKET)
+
+    def test_largest_open_files_are_uploaded_past_the_disk_limit(self):
+        writers = PartitionWriterManager(self.s3_client, BUCKET, max_open_files_mb=1, upload_workers=0)
+        payloads = [os.urandom(1000).hex() for _ in range(1000)] + ['small']
+        table = pa.table({'payload': payloads,
+                          'idx_year': [2021] * len(payloads),
+                          'idx_month': [1] * len(payloads),
+                          'idx_day': [1] * (len(payloads) - 1) + [2]})
+        try:
+            writers.write('events', table)
+
+            keys = [obj['Key'] for obj in self.s3_client.list_objects_v2(Bucket=BUCKET)['Contents']]
+            self.assertEqual(len(keys), 1)
+            self.assertTrue(keys[0].startswith('events/idx_year=2021/idx_month=1/idx_day=1/'))
+            self.assertEqual(list(writers.writers), [('events', 2021, 1, 2)])
+        finally:
+            writers.close()
+
+
+if __name__ == '__main__':
+    unittest.main()